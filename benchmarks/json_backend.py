@@ -0,0 +1,144 @@
+"""
+Benchmark of the JSON backends on a synthetic dump of raw tweets.
+
+    python benchmarks/json_backend.py --tweets 50000
+
+Times the decoding of the raw lines the way malformed_duplicate_filter does it
+(decode and project) and the encoding of the filtered records, with the
+standard library and with orjson when it's installed.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from recommend.json_backend import project_tweet
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun"]
+# share of the tweets that are retweets
+RETWEET_RATIO = 0.3
+
+
+def timestamp(rng):
+    return (
+        f"{rng.choice(DAYS)} {rng.choice(MONTHS)} {rng.randint(1, 28):02d} "
+        f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}"
+        " +0000 2014"
+    )
+
+
+def raw_user(rng, user_id):
+    # real user objects carry a few dozen fields the pipeline never reads
+    return {
+        "id": user_id,
+        "id_str": str(user_id),
+        "screen_name": f"user{user_id}",
+        "description": "some description " * rng.randint(0, 5),
+        "lang": "en",
+        "created_at": timestamp(rng),
+        "followers_count": rng.randint(0, 10000),
+        "friends_count": rng.randint(0, 1000),
+        "profile_image_url": f"http://example.com/{user_id}.png",
+        "profile_background_color": "C0DEED",
+        "entities": {"description": {"urls": []}},
+    }
+
+
+def raw_tweet(rng, tweet_id, *, retweet=True):
+    user_id = rng.randint(1, 100000)
+    tweet = {
+        "id": tweet_id,
+        "id_str": str(tweet_id),
+        "user": raw_user(rng, user_id),
+        "text": "lorem ipsum dolor sit amet " * rng.randint(1, 5),
+        "lang": rng.choice(["en", "es", "ja", "ar"]),
+        "created_at": timestamp(rng),
+        "in_reply_to_user_id": rng.choice([None, rng.randint(1, 100000)]),
+        "in_reply_to_status_id": None,
+        "source": '<a href="http://twitter.com">Twitter Web Client</a>',
+        "retweet_count": rng.randint(0, 100),
+        "favorite_count": rng.randint(0, 100),
+        "entities": {
+            "hashtags": [
+                {"text": f"tag{rng.randint(1, 500)}", "indices": [0, 5]}
+                for _ in range(rng.randint(1, 3))
+            ],
+            "urls": [],
+            "user_mentions": [],
+        },
+    }
+    if retweet and rng.random() < RETWEET_RATIO:
+        tweet["retweeted_status"] = raw_tweet(rng, tweet_id + 10**12, retweet=False)
+    return tweet
+
+
+def synthetic_dump(tweets, seed):
+    rng = random.Random(seed)
+    return [json.dumps(raw_tweet(rng, 10**9 + i)).encode() for i in range(tweets)]
+
+
+def best_of(repeat, func, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tweets", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    lines = synthetic_dump(args.tweets, args.seed)
+    records = [project_tweet(json.loads(line)) for line in lines]
+    size = sum(len(line) for line in lines) / 2**20
+    print(f"{args.tweets} tweets, {size:.1f} MiB")
+
+    backends = {"json": (json.loads, json.dumps)}
+    if orjson is not None:
+        backends["orjson"] = (orjson.loads, orjson.dumps)
+    else:
+        print("orjson is not installed, only the standard library is measured")
+
+    results = {}
+    for name, (loads, dumps) in backends.items():
+        results[name] = {
+            "decode": best_of(
+                args.repeat,
+                lambda loads=loads: [loads(line) for line in lines],
+            ),
+            "decode+project": best_of(
+                args.repeat,
+                lambda loads=loads: [project_tweet(loads(line)) for line in lines],
+            ),
+            "encode": best_of(
+                args.repeat,
+                lambda dumps=dumps: [dumps(obj) for obj in records],
+            ),
+        }
+
+    for step in results["json"]:
+        row = f"{step:>15}"
+        for name, timings in results.items():
+            speedup = results["json"][step] / timings[step]
+            row += f"  {name} {timings[step]:7.3f}s ({speedup:4.1f}x)"
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Benchmark of the ranking on the configured database, stage by stage.
+
+    python benchmarks/ranking.py --users 200 --output results.json
+    python benchmarks/ranking.py --users 200 --compare results.json
+
+Ranks a seeded sample of users and times every stage of RankingScore (the
+interaction, hashtag and keyword scores, their combination and the hydration
+of the ranked users), the engine end to end and the /q2 view itself. Every
+stage reports the p50/p95/p99 and mean latencies and its number of queries.
+The view is timed cold: the local recommendation cache is cleared before every
+request and the shared cache backend isn't used.
+
+The results can be written to a JSON file with the commit and the size of the
+dataset, and compared to the file of an earlier run. Use
+benchmarks/synthetic.py to load a dataset of a given size.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+from datetime import UTC
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "user_recommendation.settings")
+
+import django
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+
+from recommend.cache import get_dataset_version  # noqa: E402
+from recommend.cache import recommendation_cache  # noqa: E402
+from recommend.graph import get_interaction_graph  # noqa: E402
+from recommend.models import Hashtag  # noqa: E402
+from recommend.models import Tweet  # noqa: E402
+from recommend.models import TweetUser  # noqa: E402
+from recommend.views import RankingScore  # noqa: E402
+from recommend.views import format_recommendations  # noqa: E402
+from recommend.views import get_ranking_engine  # noqa: E402
+from recommend.views import recommend_users  # noqa: E402
+
+STAGES = (
+    "interactions",
+    "hashtags",
+    "keywords",
+    "combine",
+    "hydrate",
+    "engine",
+    "endpoint",
+)
+
+
+def measure(func):
+    """
+    The result of func, its duration in seconds and its number of queries
+    """
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+    return result, elapsed, len(queries)
+
+
+def percentile(values, p):
+    # nearest rank on the sorted values
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(timings, queries):
+    timings = sorted(timings)
+    return {
+        "p50_ms": round(percentile(timings, 50) * 1000, 3),
+        "p95_ms": round(percentile(timings, 95) * 1000, 3),
+        "p99_ms": round(percentile(timings, 99) * 1000, 3),
+        "mean_ms": round(sum(timings) / len(timings) * 1000, 3),
+        "queries_mean": round(sum(queries) / len(queries), 2),
+        "queries_max": max(queries),
+    }
+
+
+def git_commit():
+    git = shutil.which("git")
+    if git is None:
+        return None
+    try:
+        return subprocess.run(  # noqa: S603
+            [git, "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(user_ids, args):
+    version = get_dataset_version()
+    graph = get_interaction_graph(version)
+    engine = get_ranking_engine(args.engine)
+    factory = RequestFactory()
+    query = {"user_id": 0, "type": args.type, "phrase": args.phrase}
+    if args.hashtag is not None:
+        query["hashtag"] = args.hashtag
+    if args.limit is not None:
+        query["limit"] = args.limit
+
+    timings = {stage: [] for stage in STAGES}
+    queries = {stage: [] for stage in STAGES}
+
+    def record(stage, func):
+        result, elapsed, count = measure(func)
+        timings[stage].append(elapsed)
+        queries[stage].append(count)
+        return result
+
+    for user_id in user_ids:
+        scorer = RankingScore(user_id, args.type, args.phrase, args.hashtag, graph)
+        interaction_scores = record("interactions", scorer.calculate_interaction_scores)
+        hashtag_scores = record("hashtags", scorer.calculate_hashtag_scores)
+        keyword_scores = record("keywords", scorer.calculate_keywords_score)
+        # the values of this iteration are bound as defaults of the lambdas
+        final_scores = record(
+            "combine",
+            lambda scores=(interaction_scores, hashtag_scores, keyword_scores): (
+                RankingScore.combine_scores(*scores, limit=args.limit)
+            ),
+        )
+        record(
+            "hydrate",
+            lambda user_id=user_id, final_scores=final_scores: format_recommendations(
+                user_id,
+                final_scores,
+            ),
+        )
+
+        ranking = engine(user_id, args.type, args.phrase, args.hashtag, graph=graph)
+        record(
+            "engine",
+            lambda ranking=ranking: ranking.calculate_final_scores(limit=args.limit),
+        )
+
+        recommendation_cache.clear()
+        request = factory.get("/q2", {**query, "user_id": user_id})
+        record("endpoint", lambda request=request: recommend_users(request).render())
+
+    return {stage: summarize(timings[stage], queries[stage]) for stage in STAGES}
+
+
+def compare(results, previous):
+    print(f"compared to {previous.get('commit')} ({previous.get('created_at')})")
+    for stage, summary in results["stages"].items():
+        before = previous.get("stages", {}).get(stage)
+        if before is None:
+            continue
+        row = f"{stage:>12}"
+        for key in ("p50_ms", "p95_ms"):
+            ratio = before[key] / summary[key] if summary[key] else math.inf
+            row += f"  {key} {before[key]:9.3f} -> {summary[key]:9.3f} ({ratio:4.2f}x)"
+        print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--type", default="both", choices=["reply", "retweet", "both"])
+    parser.add_argument("--phrase", default="")
+    parser.add_argument("--hashtag", default=None)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--engine", default=None, choices=["python", "sql"])
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--compare", type=Path, default=None)
+    args = parser.parse_args()
+
+    all_user_ids = list(TweetUser.objects.order_by("id").values_list("id", flat=True))
+    if not all_user_ids:
+        sys.exit("The database has no users, load a dataset first")
+    rng = random.Random(args.seed)
+    user_ids = rng.sample(all_user_ids, min(args.users, len(all_user_ids)))
+
+    # the view is measured without the shared cache, entries from other runs
+    # would be hits
+    recommendation_cache.backend = None
+    stages = benchmark(user_ids, args)
+
+    results = {
+        "commit": git_commit(),
+        "created_at": datetime.now(UTC).isoformat(timespec="seconds"),
+        "dataset": {
+            "version": get_dataset_version(),
+            "users": len(all_user_ids),
+            "tweets": Tweet.objects.count(),
+            "hashtags": Hashtag.objects.count(),
+        },
+        "params": {
+            "sampled_users": len(user_ids),
+            "seed": args.seed,
+            "type": args.type,
+            "phrase": args.phrase,
+            "hashtag": args.hashtag,
+            "limit": args.limit,
+            "engine": args.engine,
+        },
+        "stages": stages,
+    }
+
+    dataset = results["dataset"]
+    print(
+        f"{len(user_ids)} users sampled from {dataset['users']} users, "
+        f"{dataset['tweets']} tweets and {dataset['hashtags']} hashtags",
+    )
+    for stage, summary in stages.items():
+        print(
+            f"{stage:>12}  p50 {summary['p50_ms']:9.3f}ms"
+            f"  p95 {summary['p95_ms']:9.3f}ms  p99 {summary['p99_ms']:9.3f}ms"
+            f"  mean {summary['mean_ms']:9.3f}ms"
+            f"  queries {summary['queries_mean']:6.2f} (max {summary['queries_max']})",
+        )
+
+    if args.compare is not None:
+        compare(results, json.loads(args.compare.read_text()))
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Seeded generator of synthetic datasets in the format of the filtered files, to
+benchmark the ranking at sizes the real dump doesn't have.
+
+    python benchmarks/synthetic.py /tmp/synthetic --tweets 1000000
+    python manage.py load_dataset --users /tmp/synthetic/valid_usr_obj.txt \
+        --tweets /tmp/synthetic/valid_tweet_objects.txt \
+        --hashtags /tmp/synthetic/valid_hashtags.txt
+
+The activity of the users, the users replied to and retweeted, the words and
+the hashtags all follow power laws, so a few users and tags get most of the
+traffic like on Twitter. The same seed and sizes always give the same files.
+"""
+
+import argparse
+import random
+import sys
+import time
+from datetime import UTC
+from datetime import datetime
+from datetime import timedelta
+from itertools import accumulate
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from recommend.json_backend import dumps
+from recommend.timestamps import DATE_FORMAT
+
+USERS_FILE = "valid_usr_obj.txt"
+TWEETS_FILE = "valid_tweet_objects.txt"
+HASHTAGS_FILE = "valid_hashtags.txt"
+
+# mostly languages the ranking keeps, some it leaves out
+LANGUAGES = ["en", "es", "ja", "pt", "ar", "fr", "tr", "in", "de", "ko"]
+LANGUAGE_WEIGHTS = [40, 15, 10, 8, 5, 4, 3, 3, 6, 6]
+
+VOCABULARY_SIZE = 5000
+HASHTAG_VOCABULARY_SIZE = 2000
+# retweets pick one of the latest tweets, older ones are rarely retweeted
+RETWEET_WINDOW = 100000
+DRAW_BATCH = 10000
+# share of the hashtags written in upper case
+UPPER_CASE_RATIO = 0.1
+
+
+def zipf_cum_weights(size, exponent):
+    return list(accumulate(1 / (rank + 1) ** exponent for rank in range(size)))
+
+
+class Draws:
+    """
+    Draws from a weighted population, a batch at a time since random.choices
+    is much faster for many values at once
+    """
+
+    def __init__(self, rng, population, cum_weights):
+        self.rng = rng
+        self.population = population
+        self.cum_weights = cum_weights
+        self.batch = []
+
+    def next(self):
+        if not self.batch:
+            self.batch = self.rng.choices(
+                self.population,
+                cum_weights=self.cum_weights,
+                k=DRAW_BATCH,
+            )
+        return self.batch.pop()
+
+
+def generate_dataset(  # noqa: PLR0913
+    output_dir,
+    tweets,
+    *,
+    users=None,
+    seed=42,
+    reply_ratio=0.3,
+    retweet_ratio=0.2,
+    exponent=1.1,
+):
+    """
+    Write the users, tweets and hashtags files of a synthetic dataset with the
+    given number of tweets (and a tenth as many users by default) to
+    output_dir, returns the number of records written to each
+    """
+    rng = random.Random(seed)
+    users = users or max(10, tweets // 10)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    user_ids = [10**8 + index for index in range(users)]
+    # the most active users aren't the ones with the smallest ids
+    ranked_users = user_ids[:]
+    rng.shuffle(ranked_users)
+    user_weights = zipf_cum_weights(users, exponent)
+    authors = Draws(rng, ranked_users, user_weights)
+    # popular users get replied to more, by everyone
+    reply_targets = Draws(rng, ranked_users, user_weights)
+
+    words = [f"w{index}" for index in range(VOCABULARY_SIZE)]
+    word_weights = zipf_cum_weights(VOCABULARY_SIZE, exponent)
+    tags = [f"tag{index}" for index in range(HASHTAG_VOCABULARY_SIZE)]
+    tags_weights = zipf_cum_weights(HASHTAG_VOCABULARY_SIZE, exponent)
+    languages = Draws(rng, LANGUAGES, list(accumulate(LANGUAGE_WEIGHTS)))
+
+    start = datetime(2014, 1, 1, tzinfo=UTC)
+    counts = {"users": 0, "tweets": 0, "hashtags": 0}
+
+    with (output_dir / USERS_FILE).open("w") as file:
+        for user_id in user_ids:
+            created_at = start - timedelta(days=rng.randint(0, 2000))
+            user = {
+                "id": user_id,
+                "screen_name": f"user{user_id}",
+                "description": rng.choice([None, f"about {rng.choice(words)}"]),
+                "lang": languages.next(),
+                "created_at": created_at.strftime(DATE_FORMAT),
+                "updated_at": start.strftime(DATE_FORMAT),
+            }
+            file.write(dumps(user) + "\n")
+            counts["users"] += 1
+
+    recent_tweets = []
+    with (
+        (output_dir / TWEETS_FILE).open("w") as tweets_file,
+        (output_dir / HASHTAGS_FILE).open("w") as hashtags_file,
+    ):
+        created_at = start
+        for index in range(tweets):
+            tweet_id = 10**9 + index
+            user_id = authors.next()
+            created_at += timedelta(seconds=rng.randint(0, 60))
+            tweet = {
+                "id": tweet_id,
+                "user": user_id,
+                "text": " ".join(
+                    rng.choices(words, cum_weights=word_weights, k=rng.randint(3, 20)),
+                ),
+                "reply_to_user": None,
+                "lang": languages.next(),
+                "created_at": created_at.strftime(DATE_FORMAT),
+            }
+
+            kind = rng.random()
+            if kind < reply_ratio:
+                tweet["reply_to_user"] = reply_targets.next()
+            elif kind < reply_ratio + retweet_ratio and recent_tweets:
+                tweet["retweet"] = rng.choice(recent_tweets)
+
+            tweets_file.write(dumps(tweet) + "\n")
+            counts["tweets"] += 1
+
+            if len(recent_tweets) < RETWEET_WINDOW:
+                recent_tweets.append(tweet_id)
+            else:
+                recent_tweets[index % RETWEET_WINDOW] = tweet_id
+
+            # dict keeps the draw order, unlike a set of strings
+            count = rng.choice([0, 0, 1, 2, 3])
+            for tag in dict.fromkeys(
+                rng.choices(tags, cum_weights=tags_weights, k=count),
+            ):
+                # the same tag in several cases, like the real data
+                text = tag.upper() if rng.random() < UPPER_CASE_RATIO else tag
+                hashtags_file.write(
+                    dumps({"user": user_id, "tweet": tweet_id, "text": text}) + "\n",
+                )
+                counts["hashtags"] += 1
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("output_dir", type=Path)
+    parser.add_argument("--tweets", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--reply-ratio", type=float, default=0.3)
+    parser.add_argument("--retweet-ratio", type=float, default=0.2)
+    parser.add_argument("--exponent", type=float, default=1.1)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = generate_dataset(
+        args.output_dir,
+        args.tweets,
+        users=args.users,
+        seed=args.seed,
+        reply_ratio=args.reply_ratio,
+        retweet_ratio=args.retweet_ratio,
+        exponent=args.exponent,
+    )
+    print(
+        f"{counts['users']} users, {counts['tweets']} tweets and "
+        f"{counts['hashtags']} hashtags written to {args.output_dir} in "
+        f"{time.perf_counter() - start:.1f}s",
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Micro-benchmark of recommend.timestamps against datetime.strptime.
+
+    python benchmarks/timestamps.py --values 200000 --distinct 20000
+
+The values are drawn from a pool of distinct timestamps, like a dump where
+many records share the same second.
+"""
+
+import argparse
+import random
+import sys
+import time
+from datetime import UTC
+from datetime import datetime
+from datetime import timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from recommend.timestamps import DATE_FORMAT
+from recommend.timestamps import _parse
+from recommend.timestamps import parse_twitter_datetime
+
+
+def strptime(value):
+    # DATE_FORMAT has a %z, the result is aware
+    return datetime.strptime(value, DATE_FORMAT)  # noqa: DTZ007
+
+
+def best_of(repeat, func, values):
+    timings = []
+    for _ in range(repeat):
+        parse_twitter_datetime.cache_clear()
+        start = time.perf_counter()
+        for value in values:
+            func(value)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--values", type=int, default=200000)
+    parser.add_argument("--distinct", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    start = datetime(2014, 1, 1, tzinfo=UTC)
+    pool = [
+        (start + timedelta(seconds=rng.randint(0, 10**7))).strftime(DATE_FORMAT)
+        for _ in range(args.distinct)
+    ]
+    values = [rng.choice(pool) for _ in range(args.values)]
+
+    assert all(parse_twitter_datetime(value) == strptime(value) for value in pool)
+
+    baseline = best_of(args.repeat, strptime, values)
+    print(f"{args.values} values, {args.distinct} distinct")
+    for name, func in [
+        ("strptime", strptime),
+        ("sliced", _parse),
+        ("sliced+memoized", parse_twitter_datetime),
+    ]:
+        elapsed = baseline if name == "strptime" else best_of(args.repeat, func, values)
+        print(
+            f"{name:>16} {elapsed:7.3f}s  {elapsed / args.values * 1e9:6.0f} ns/value"
+            f"  ({baseline / elapsed:5.1f}x)",
+        )
+
+
+if __name__ == "__main__":
+    main()
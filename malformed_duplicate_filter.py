@@ -1,13 +1,24 @@
-import json
+import mmap
+import os
 
-from datetime import datetime as dt
+from array import array
+from collections import deque
+from itertools import islice, pairwise
 from multiprocessing import Pool
 from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from recommend.json_backend import JSONDecodeError, dumps, loads_tweet
+from recommend.timestamps import parse_twitter_datetime
 
 # Note: The language consideration is only for Query 2
 # valid_languages = ["ar", "en", "fr", "in", "pt", "es", "tr", "ja"]
 
-date_format = "%a %b %d %H:%M:%S %z %Y"
+# lines handed to a worker at a time
+CHUNK_LINES = 10000
+
+# byte ranges per process when the input is split by bytes
+RANGES_PER_PROCESS = 4
 
 
 def get_tweet_objs(objs):
@@ -18,8 +29,6 @@ def get_tweet_objs(objs):
     valid_twts = []
 
     for twt in objs:
-        print(f"tweet line {len(valid_twts)}")
-
         tweet_obj = {
             "id": twt.get("id"),
             "user": twt["user"]["id"],
@@ -51,82 +60,76 @@ def get_tweet_objs(objs):
     return valid_twts
 
 
+def add_user_obj(valid_users, user_obj):
+    """
+    keep the latest profile of a user, the profiles are keyed by user id along
+    with their parsed updated_at so every timestamp is only parsed once
+    """
+    updated_at = parse_twitter_datetime(user_obj["updated_at"])
+    existing = valid_users.get(user_obj["id"])
+
+    # since we are using the created datetime to check for updated info, an
+    # older or same profile doesn't replace the one we have
+    if existing is None or updated_at > existing[0]:
+        valid_users[user_obj["id"]] = (updated_at, user_obj)
+
+
 def get_user_objs(objs):
     """
-    function to get the user objects for the table
+    function to get the user objects for the table. This is the map side of the
+    user consolidation, it returns the latest profile per user of the given
+    objects as {id: (updated_at, profile)}, see merge_user_objs for the reduce
     """
-    user_ids = set()
-    valid_users = []
+    valid_users = {}
 
     for twt in objs:
-        print(f"user line {len(valid_users)}")
-
-        user_info = {
-            "id": twt["user"]["id"],
-            "screen_name": twt["user"]["screen_name"],
-            "description": twt["user"]["description"],
-            "lang": twt["user"]["lang"],
-            "created_at": twt["user"]["created_at"],
-            "updated_at": twt["created_at"],
-        }
-
         if twt.get("retweeted_status") is not None:
-            retweet_data = {
-                "id": twt.get("retweeted_status").get("user").get("id"),
-                "screen_name": twt.get("retweeted_status")
-                .get("user")
-                .get("screen_name"),
-                "description": twt.get("retweeted_status")
-                .get("user")
-                .get("description"),
-                "lang": twt.get("retweeted_status").get("user").get("lang"),
-                "created_at": twt.get("retweeted_status").get("user").get("created_at"),
-                "updated_at": twt["retweeted_status"]["created_at"],
-            }
-
-            if retweet_data.get("id") not in user_ids:
-                user_ids.add(retweet_data.get("id"))
-                valid_users.append(retweet_data)
-
-            # since the data is in chronological order and we are using the
-            # created datetime to check for updated info, we'll add an else condition
-            # to do just that
-            else:
-                existing_data = [
-                    data
-                    for data in valid_users
-                    if data.get("id") == retweet_data.get("id")
-                ]
-                datetime_2 = dt.strptime(retweet_data["updated_at"], date_format)
-                datetime_1 = dt.strptime(
-                    existing_data[0].get("updated_at"), date_format
-                )
-
-                if datetime_2 > datetime_1:
-                    # update the object in place
-                    existing_data[0].update(retweet_data)
-
-        if user_info.get("id") not in user_ids:
-            user_ids.add(user_info.get("id"))
-            valid_users.append(user_info)
-
-        # since the data is in chronological order and we are using the
-        # created datetime to check for updated info, we'll add an else condition
-        # to do just that
-        else:
-            existing_data = [
-                data for data in valid_users if data.get("id") == user_info.get("id")
-            ]
-            datetime_2 = dt.strptime(user_info["updated_at"], date_format)
-            datetime_1 = dt.strptime(existing_data[0].get("updated_at"), date_format)
-
-            if datetime_2 > datetime_1:
-                # update the object in place
-                existing_data[0].update(user_info)
+            retweet_user = twt["retweeted_status"]["user"]
+            add_user_obj(
+                valid_users,
+                {
+                    "id": retweet_user.get("id"),
+                    "screen_name": retweet_user.get("screen_name"),
+                    "description": retweet_user.get("description"),
+                    "lang": retweet_user.get("lang"),
+                    "created_at": retweet_user.get("created_at"),
+                    "updated_at": twt["retweeted_status"]["created_at"],
+                },
+            )
+
+        add_user_obj(
+            valid_users,
+            {
+                "id": twt["user"]["id"],
+                "screen_name": twt["user"]["screen_name"],
+                "description": twt["user"]["description"],
+                "lang": twt["user"]["lang"],
+                "created_at": twt["user"]["created_at"],
+                "updated_at": twt["created_at"],
+            },
+        )
+
+    return valid_users
 
+
+def merge_user_objs(valid_users, partial_users):
+    """
+    reduce side of the user consolidation: merge the partial result of a chunk
+    or a worker into valid_users, keeping the latest profile of every user. A
+    user keeps the position where it was first seen
+    """
+    for user_id, (updated_at, user_obj) in partial_users.items():
+        existing = valid_users.get(user_id)
+        if existing is None or updated_at > existing[0]:
+            valid_users[user_id] = (updated_at, user_obj)
     return valid_users
 
 
+def write_user_objs(user_file, valid_users):
+    for _, user_obj in valid_users.values():
+        user_file.write(dumps(user_obj) + "\n")
+
+
 def get_hashtags(objs):
     """
     function to get all valid hashtags in relation to the user id for the database
@@ -135,8 +138,6 @@ def get_hashtags(objs):
     valid_hashtags = []
 
     for twt in objs:
-        print(f" hashtag line {len(valid_hashtags)}")
-
         twt_user_id = twt.get("user").get("id")
         twt_obj_id = twt.get("id")
 
@@ -175,9 +176,9 @@ def process_lines(lines):
     valid_objects = []
 
     for line in lines:
-        print(f"process line {len(valid_objects)}")
         try:
-            obj = json.loads(line.strip())
+            # only the fields used below are kept, see project_tweet
+            obj = loads_tweet(line.strip())
             obj_id = obj.get("id")
             obj_id_str = obj.get("id_str")
 
@@ -210,76 +211,267 @@ def process_lines(lines):
             if obj_identity is not None and obj_identity not in unique_ids:
                 unique_ids.add(int(obj_identity))
                 valid_objects.append(obj)
-        except (json.JSONDecodeError, KeyError):
+        except (JSONDecodeError, UnicodeDecodeError, KeyError):
             continue
 
     return valid_objects
 
 
-def process_file(
-    input_file, twt_output_file, usr_output_file, hshtags_out_file, num_processes
-):
-    with open(input_file, "r") as file:
-        lines = file.readlines()
+def extract_records(lines):
+    """
+    worker side of the pipeline: every line is decoded once and the tweet, user
+    and hashtag records are all taken from the same objects
+    """
+    valid_objects = process_lines(lines)
+    return (
+        get_tweet_objs(valid_objects),
+        get_user_objs(valid_objects),
+        get_hashtags(valid_objects),
+    )
 
-    # Split lines into chunks
-    chunk_size = len(lines) // num_processes
-    chunks = [lines[i : i + chunk_size] for i in range(0, len(lines), chunk_size)]
 
-    # filter for malformed and dupicate
-    with Pool(processes=num_processes) as pool:
-        results = pool.map(process_lines, chunks)
+def read_chunks(file, chunk_lines):
+    """
+    lazily split the input in chunks of lines, so only the chunks being worked
+    on are ever in memory
+    """
+    while chunk := list(islice(file, chunk_lines)):
+        yield chunk
 
-    # double checking
-    unique_ids = set()
-    valid_objects = []
-    for result in results:
-        for obj in result:
-            obj_id = obj["id"]
-            if obj_id not in unique_ids:
-                unique_ids.add(obj_id)
-                valid_objects.append(obj)
 
-    # anticipating changes
-    tweets_chunk_size = len(valid_objects) // num_processes
-    tweets_chunks = [
-        valid_objects[i : i + tweets_chunk_size]
-        for i in range(0, len(valid_objects), tweets_chunk_size)
-    ]
-
-    # filter for tweet data
-    with Pool(processes=num_processes) as pool:
-        valid_tweets_objects = pool.map(get_tweet_objs, tweets_chunks)
-
-    # filter for user data
-    with Pool(processes=num_processes) as pool:
-        valid_user_objects = pool.map(get_user_objs, tweets_chunks)
-
-    # filer for hashtags
-    with Pool(processes=num_processes) as pool:
-        valid_hashtag_objects = pool.map(get_hashtags, tweets_chunks)
-
-    # write results to files
-    # tweet result
-    # flattenout the list
-    valid_twt_list = [obj for sublist in valid_tweets_objects for obj in sublist]
-    with open(twt_output_file, "w") as tweet_file:
-        for obj in valid_twt_list:
-            tweet_file.write(json.dumps(obj) + "\n")
-
-    # user result
-    # flattenout the list
-    valid_usr_list = [obj for sublist in valid_user_objects for obj in sublist]
-    with open(usr_output_file, "w") as user_file:
-        for obj in valid_usr_list:
-            user_file.write(json.dumps(obj) + "\n")
-
-    # hashtags result
-    # flatten out thelist
-    valid_hashtag_list = [obj for sublist in valid_hashtag_objects for obj in sublist]
-    with open(hshtags_out_file, "w") as hashtag_file:
-        for obj in valid_hashtag_list:
-            hashtag_file.write(json.dumps(obj) + "\n")
+def imap_bounded(pool, func, iterable, max_in_flight):
+    """
+    like Pool.imap, but never more than max_in_flight chunks are read ahead.
+    Pool.imap consumes the whole input up front
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+def split_ranges(input_file, parts):
+    """
+    split the file in byte ranges of about the same size, every range starts at
+    the beginning of a line and ends right after a newline (or at the end)
+    """
+    size = os.path.getsize(input_file)
+    boundaries = [0]
+
+    with open(input_file, "rb") as file:
+        for part in range(1, parts):
+            # move to the start of the line following the rough boundary
+            file.seek(max(size * part // parts - 1, boundaries[-1]))
+            file.readline()
+            position = file.tell()
+            if position >= size:
+                break
+            if position > boundaries[-1]:
+                boundaries.append(position)
+
+    boundaries.append(size)
+    return [(start, end) for start, end in pairwise(boundaries) if start < end]
+
+
+def read_range(input_file, start, end):
+    """
+    lines of the given byte range, read straight from a memory map of the file
+    """
+    with (
+        open(input_file, "rb") as file,
+        mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+    ):
+        mapped.seek(start)
+        while mapped.tell() < end:
+            yield mapped.readline()
+
+
+def process_range(task):
+    """
+    worker for the byte range split: the worker reads its own range, writes its
+    tweets and hashtags to part files and only sends back the ids needed to
+    de-duplicate the parts against each other, plus its partial users
+    """
+    input_file, start, end, part_prefix, chunk_lines = task
+
+    tweet_ids = set()
+    hashtag_tweets = set()
+    written_tweets = array("q")
+    written_hashtag_users = array("q")
+    written_hashtag_tweets = array("q")
+    valid_users = {}
+
+    with (
+        open(f"{part_prefix}.tweets", "w", encoding="utf-8") as tweet_file,
+        open(f"{part_prefix}.hashtags", "w", encoding="utf-8") as hashtag_file,
+    ):
+        for chunk in read_chunks(read_range(input_file, start, end), chunk_lines):
+            tweets, users, hashtags = extract_records(chunk)
+
+            for obj in tweets:
+                if obj["id"] not in tweet_ids:
+                    tweet_ids.add(obj["id"])
+                    written_tweets.append(obj["id"])
+                    tweet_file.write(dumps(obj) + "\n")
+
+            merge_user_objs(valid_users, users)
+
+            chunk_tweets = set()
+            for obj in hashtags:
+                key = (obj["user"], obj["tweet"])
+                if key not in hashtag_tweets:
+                    chunk_tweets.add(key)
+                    written_hashtag_users.append(obj["user"])
+                    written_hashtag_tweets.append(obj["tweet"])
+                    hashtag_file.write(dumps(obj) + "\n")
+            hashtag_tweets.update(chunk_tweets)
+
+    return (
+        part_prefix,
+        written_tweets,
+        written_hashtag_users,
+        written_hashtag_tweets,
+        valid_users,
+    )
+
+
+def process_file_ranges(
+    input_file,
+    twt_output_file,
+    usr_output_file,
+    hshtags_out_file,
+    num_processes,
+    chunk_lines=CHUNK_LINES,
+):
+    # a few ranges per process so a slow range doesn't hold up the others
+    ranges = split_ranges(input_file, num_processes * RANGES_PER_PROCESS)
+
+    with TemporaryDirectory(dir=Path(twt_output_file).parent) as parts_dir:
+        tasks = [
+            (input_file, start, end, f"{parts_dir}/{index}", chunk_lines)
+            for index, (start, end) in enumerate(ranges)
+        ]
+
+        tweet_ids = set()
+        hashtag_tweets = set()
+        valid_users = {}
+
+        with (
+            open(twt_output_file, "w", encoding="utf-8") as tweet_file,
+            open(usr_output_file, "w", encoding="utf-8") as user_file,
+            open(hshtags_out_file, "w", encoding="utf-8") as hashtag_file,
+            Pool(processes=num_processes) as pool,
+        ):
+            # parts are merged in the file order, so the first occurrence of a
+            # tweet wins like it does within a part
+            for (
+                part_prefix,
+                part_tweets,
+                hashtag_users,
+                hashtag_twts,
+                part_users,
+            ) in pool.imap(process_range, tasks):
+                with open(f"{part_prefix}.tweets", "r", encoding="utf-8") as part:
+                    for obj_id, line in zip(part_tweets, part, strict=True):
+                        if obj_id not in tweet_ids:
+                            tweet_ids.add(obj_id)
+                            tweet_file.write(line)
+
+                merge_user_objs(valid_users, part_users)
+
+                part_hashtag_tweets = set()
+                with open(f"{part_prefix}.hashtags", "r", encoding="utf-8") as part:
+                    keys = zip(hashtag_users, hashtag_twts, strict=True)
+                    for key, line in zip(keys, part, strict=True):
+                        if key not in hashtag_tweets:
+                            part_hashtag_tweets.add(key)
+                            hashtag_file.write(line)
+                hashtag_tweets.update(part_hashtag_tweets)
+
+                for suffix in ("tweets", "hashtags"):
+                    os.remove(f"{part_prefix}.{suffix}")
+
+            # users can only be written once every part is merged
+            write_user_objs(user_file, valid_users)
+
+
+def process_file_lines(
+    input_file,
+    twt_output_file,
+    usr_output_file,
+    hshtags_out_file,
+    num_processes,
+    chunk_lines=CHUNK_LINES,
+):
+    # ids already written, the same tweet can come back in later chunks
+    tweet_ids = set()
+    hashtag_tweets = set()
+    valid_users = {}
+
+    with (
+        open(input_file, "r", encoding="utf-8") as file,
+        open(twt_output_file, "w", encoding="utf-8") as tweet_file,
+        open(usr_output_file, "w", encoding="utf-8") as user_file,
+        open(hshtags_out_file, "w", encoding="utf-8") as hashtag_file,
+        Pool(processes=num_processes) as pool,
+    ):
+        results = imap_bounded(
+            pool,
+            extract_records,
+            read_chunks(file, chunk_lines),
+            max_in_flight=num_processes * 2,
+        )
+
+        # results come back in the input order and are written right away
+        for tweets, users, hashtags in results:
+            for obj in tweets:
+                if obj["id"] not in tweet_ids:
+                    tweet_ids.add(obj["id"])
+                    tweet_file.write(dumps(obj) + "\n")
+
+            merge_user_objs(valid_users, users)
+
+            # a tweet's hashtags all come from the same chunk, so the ones of
+            # tweets seen in earlier chunks are skipped
+            chunk_tweets = set()
+            for obj in hashtags:
+                key = (obj["user"], obj["tweet"])
+                if key not in hashtag_tweets:
+                    chunk_tweets.add(key)
+                    hashtag_file.write(dumps(obj) + "\n")
+            hashtag_tweets.update(chunk_tweets)
+
+        # users can only be written once every chunk is merged
+        write_user_objs(user_file, valid_users)
+
+
+def process_file(
+    input_file,
+    twt_output_file,
+    usr_output_file,
+    hshtags_out_file,
+    num_processes,
+    chunk_lines=CHUNK_LINES,
+    split="bytes",
+):
+    """
+    split="bytes" has every worker read its own byte range of the input, which
+    is what scales on big dumps. split="lines" has the parent read the lines
+    and hand them out in chunks
+    """
+    process = {"bytes": process_file_ranges, "lines": process_file_lines}[split]
+    process(
+        input_file,
+        twt_output_file,
+        usr_output_file,
+        hshtags_out_file,
+        num_processes,
+        chunk_lines=chunk_lines,
+    )
 
 
 if __name__ == "__main__":
@@ -290,7 +482,7 @@ if __name__ == "__main__":
     usr_output_file = f"{base_path}/filtered/valid_usr_obj.txt"
     hshtags_out_file = f"{base_path}/filtered/valid_hashtags.txt"
 
-    num_processes = 4
+    num_processes = os.cpu_count() or 4
 
     process_file(
         input_file_path,
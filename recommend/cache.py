@@ -0,0 +1,159 @@
+"""
+Cache for the recommendation endpoint. Entries are kept in a bounded in-process
+LRU and, when RECOMMEND_CACHE["BACKEND"] names one of the CACHES, in that Django
+cache as well. Keys include the dataset version so a bump from the management
+commands makes every older entry unreachable.
+
+The LRU is emptied the first time a newer version is seen. A request that read
+the version before a bump can still finish after it, what it stores is kept
+under its own version and never served to the requests of the newer one.
+"""
+
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+
+from .metrics import CACHE_LOOKUPS
+from .models import DatasetVersion
+
+DATASET_VERSION_ID = 1
+
+
+def get_dataset_version():
+    version = (
+        DatasetVersion.objects.filter(pk=DATASET_VERSION_ID)
+        .values_list("version", flat=True)
+        .first()
+    )
+    return version or 0
+
+
+def bump_dataset_version():
+    """
+    Called by the commands that change the data, returns the new version
+    """
+    updated = DatasetVersion.objects.filter(pk=DATASET_VERSION_ID).update(
+        version=F("version") + 1
+    )
+    if not updated:
+        DatasetVersion.objects.get_or_create(
+            pk=DATASET_VERSION_ID, defaults={"version": 1}
+        )
+    return get_dataset_version()
+
+
+class LRUCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RecommendationCache:
+    def __init__(self, max_entries, backend=None, timeout=None):
+        self.local = LRUCache(max_entries)
+        self.backend = backend
+        self.timeout = timeout
+        self.version = None
+        self._version_lock = Lock()
+        self.local_hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_settings(cls):
+        options = getattr(settings, "RECOMMEND_CACHE", {})
+        backend = options.get("BACKEND")
+        return cls(
+            max_entries=options.get("MAX_ENTRIES", 4096),
+            backend=caches[backend] if backend else None,
+            timeout=options.get("TIMEOUT"),
+        )
+
+    def _check_version(self, version):
+        # entries of older versions can never be hit again, free them
+        with self._version_lock:
+            if self.version is None or version > self.version:
+                self.local.clear()
+                self.version = version
+
+    @staticmethod
+    def backend_key(namespace, version, params):
+        digest = sha1(repr(params).encode(), usedforsecurity=False).hexdigest()
+        return f"recommend:{namespace}:{version}:{digest}"
+
+    def get(self, namespace, params, version):
+        self._check_version(version)
+
+        value = self.local.get((namespace, version, params))
+        if value is not None:
+            self.local_hits += 1
+            CACHE_LOOKUPS.inc(result="local_hit")
+            return value
+
+        if self.backend is not None:
+            value = self.backend.get(self.backend_key(namespace, version, params))
+            if value is not None:
+                self.backend_hits += 1
+                CACHE_LOOKUPS.inc(result="backend_hit")
+                self.local.set((namespace, version, params), value)
+                return value
+
+        self.misses += 1
+        CACHE_LOOKUPS.inc(result="miss")
+        return None
+
+    def set(self, namespace, params, version, value):
+        self._check_version(version)
+
+        self.local.set((namespace, version, params), value)
+        if self.backend is not None:
+            self.backend.set(
+                self.backend_key(namespace, version, params), value, self.timeout
+            )
+
+    def clear(self):
+        self.local.clear()
+        self.local_hits = self.backend_hits = self.misses = 0
+
+    def stats(self):
+        lookups = self.local_hits + self.backend_hits + self.misses
+        hits = self.local_hits + self.backend_hits
+        return {
+            "version": self.version,
+            "entries": len(self.local),
+            "local_hits": self.local_hits,
+            "backend_hits": self.backend_hits,
+            "misses": self.misses,
+            "hit_ratio": round(hits / lookups, 5) if lookups else 0.0,
+        }
+
+
+recommendation_cache = RecommendationCache.from_settings()
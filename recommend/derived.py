@@ -0,0 +1,117 @@
+"""
+Derived tables built from the raw tweet data. These are what the ranking reads
+so a request doesn't have to aggregate the whole Tweet table every time.
+"""
+
+from django.db import connection, transaction
+from django.db.models import Q
+
+from .models import Hashtag, HashtagUsage, Tweet, UserInteraction, valid_languages
+
+# every reply/retweet is an edge from the tweeting user to the other user. the
+# edges are emitted in both directions so that a single lookup on user_a
+# returns the interactions initiated by either side, self replies are ignored
+# like in the original ranking queries
+INTERACTION_SQL = """
+WITH edges AS (
+    SELECT t.user_id AS src, t.reply_to_user_id AS dst, 1 AS replies, 0 AS retweets
+    FROM {tweet} t
+    WHERE t.reply_to_user_id IS NOT NULL
+      AND t.reply_to_user_id <> t.user_id
+      AND t.lang = ANY(%(languages)s)
+      {reply_filter}
+    UNION ALL
+    SELECT t.user_id, r.user_id, 0, 1
+    FROM {tweet} t
+    JOIN {tweet} r ON r.id = t.retweet_id
+    WHERE t.lang = ANY(%(languages)s)
+      {retweet_filter}
+),
+pairs AS (
+    SELECT src AS user_a, dst AS user_b, replies, retweets FROM edges
+    UNION ALL
+    SELECT dst, src, replies, retweets FROM edges
+)
+INSERT INTO {interaction} (user_a_id, user_b_id, reply_count, retweet_count)
+SELECT user_a, user_b, SUM(replies), SUM(retweets)
+FROM pairs
+GROUP BY user_a, user_b
+"""
+
+# tags are normalized to lower case so the lookups are case insensitive, and
+# are attributed to the user of the tweet like the ranking always did
+HASHTAG_USAGE_SQL = """
+INSERT INTO {usage} (tag, user_id, count)
+SELECT LOWER(h.text), t.user_id, COUNT(*)
+FROM {hashtag} h
+JOIN {tweet} t ON t.id = h.tweet_id
+WHERE NOT h.is_popular
+GROUP BY LOWER(h.text), t.user_id
+"""
+
+
+def _truncate(cursor, model):
+    # the FK checks are deferred, postgres refuses to truncate a table with
+    # pending checks so they are run before and deferred again afterwards
+    cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+    cursor.execute(f"TRUNCATE {model._meta.db_table}")
+    cursor.execute("SET CONSTRAINTS ALL DEFERRED")
+
+
+def rebuild_user_interactions(user_ids=None):
+    """
+    Rebuild the UserInteraction table. When user_ids is given only the pairs
+    involving those users are recomputed, which is enough after loading tweets
+    of a few users. Returns the number of rows written
+    """
+    reply_filter = retweet_filter = ""
+    params = {"languages": valid_languages}
+
+    if user_ids is not None:
+        params["user_ids"] = list(user_ids)
+        if not params["user_ids"]:
+            return 0
+        reply_filter = (
+            "AND (t.user_id = ANY(%(user_ids)s) "
+            "OR t.reply_to_user_id = ANY(%(user_ids)s))"
+        )
+        retweet_filter = (
+            "AND (t.user_id = ANY(%(user_ids)s) OR r.user_id = ANY(%(user_ids)s))"
+        )
+
+    sql = INTERACTION_SQL.format(
+        tweet=Tweet._meta.db_table,
+        interaction=UserInteraction._meta.db_table,
+        reply_filter=reply_filter,
+        retweet_filter=retweet_filter,
+    )
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        if user_ids is None:
+            _truncate(cursor, UserInteraction)
+        else:
+            # any edge touching these users is recomputed in full below
+            UserInteraction.objects.filter(
+                Q(user_a_id__in=params["user_ids"])
+                | Q(user_b_id__in=params["user_ids"])
+            ).delete()
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+def rebuild_hashtag_usage():
+    """
+    Rebuild the HashtagUsage index from the Hashtag table. Needs to run after
+    the hashtags are loaded and after popular hashtags are flagged, returns the
+    number of rows written
+    """
+    sql = HASHTAG_USAGE_SQL.format(
+        usage=HashtagUsage._meta.db_table,
+        hashtag=Hashtag._meta.db_table,
+        tweet=Tweet._meta.db_table,
+    )
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        _truncate(cursor, HashtagUsage)
+        cursor.execute(sql)
+        return cursor.rowcount
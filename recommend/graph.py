@@ -0,0 +1,150 @@
+"""
+In-memory interaction graph, the UserInteraction table as NumPy CSR arrays.
+The rows of a user are a contiguous slice of the neighbor/count arrays, found
+by a binary search of the sorted user ids, so the interaction scores are
+answered without going to the database.
+
+The arrays are saved as .npy files in a snapshot directory named after the
+dataset version and opened memory-mapped, so every worker process shares the
+same pages. A snapshot is only used for the version it was built for, after a
+bump the scores come from the database again until the next build. NumPy is an
+optional dependency, without it the graph is never used.
+"""
+
+import os
+import shutil
+from math import log
+from pathlib import Path
+
+from django.conf import settings
+
+from .models import UserInteraction
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ARRAYS = ("user_ids", "offsets", "neighbors", "reply_counts", "retweet_counts")
+CHUNK_SIZE = 100000
+
+
+class InteractionGraph:
+    def __init__(
+        self, version, user_ids, offsets, neighbors, reply_counts, retweet_counts
+    ):
+        self.version = version
+        # user_ids[i] is the user of the dense index i, its rows are
+        # offsets[i]:offsets[i + 1] of the other arrays
+        self.user_ids = user_ids
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.reply_counts = reply_counts
+        self.retweet_counts = retweet_counts
+
+    @classmethod
+    def from_edges(cls, version, user_a, user_b, reply_counts, retweet_counts):
+        """
+        Build the graph from edge arrays sorted by user_a
+        """
+        user_ids, degrees = np.unique(user_a, return_counts=True)
+        offsets = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum(degrees, out=offsets[1:])
+        return cls(version, user_ids, offsets, user_b, reply_counts, retweet_counts)
+
+    @classmethod
+    def load(cls, path, version):
+        path = Path(path) / f"v{version}"
+        arrays = [np.load(path / f"{name}.npy", mmap_mode="r") for name in ARRAYS]
+        return cls(version, *arrays)
+
+    def save(self, path):
+        """
+        Write the snapshot of this graph under path, replacing the older ones.
+        It is written next to them and renamed, so readers never see half of it
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        target = path / f"v{self.version}"
+        tmp = path / f".v{self.version}.{os.getpid()}"
+        tmp.mkdir()
+        for name in ARRAYS:
+            np.save(tmp / f"{name}.npy", getattr(self, name))
+
+        shutil.rmtree(target, ignore_errors=True)
+        tmp.rename(target)
+        # processes that have the old snapshots mapped keep their pages
+        for old in path.glob("v*"):
+            if old != target:
+                shutil.rmtree(old, ignore_errors=True)
+        return target
+
+    def __len__(self):
+        return len(self.neighbors)
+
+    def _rows(self, user_id):
+        index = int(np.searchsorted(self.user_ids, user_id))
+        if index == len(self.user_ids) or self.user_ids[index] != user_id:
+            return slice(0, 0)
+        return slice(int(self.offsets[index]), int(self.offsets[index + 1]))
+
+    def interaction_scores(self, user_id):
+        """
+        Same as RankingScore.calculate_interaction_scores
+        """
+        rows = self._rows(user_id)
+        replies = self.reply_counts[rows].astype(np.int64)
+        weights = 1 + 2 * replies + self.retweet_counts[rows]
+        # math.log on python ints, so the scores are the same to the last bit
+        return dict(
+            zip(self.neighbors[rows].tolist(), map(log, weights.tolist()), strict=True)
+        )
+
+
+def build_interaction_graph(version):
+    """
+    Read the UserInteraction table into an InteractionGraph
+    """
+    chunks = []
+    rows = UserInteraction.objects.order_by("user_a_id", "user_b_id").values_list(
+        "user_a_id", "user_b_id", "reply_count", "retweet_count"
+    )
+    batch = []
+    for row in rows.iterator(chunk_size=CHUNK_SIZE):
+        batch.append(row)
+        if len(batch) == CHUNK_SIZE:
+            chunks.append(np.array(batch, dtype=np.int64))
+            batch = []
+    if batch or not chunks:
+        chunks.append(np.array(batch, dtype=np.int64).reshape(-1, 4))
+
+    edges = np.concatenate(chunks)
+    return InteractionGraph.from_edges(
+        version,
+        np.ascontiguousarray(edges[:, 0]),
+        np.ascontiguousarray(edges[:, 1]),
+        edges[:, 2].astype(np.int32),
+        edges[:, 3].astype(np.int32),
+    )
+
+
+_loaded_graph = None
+
+
+def get_interaction_graph(version):
+    """
+    The snapshot of the given dataset version, opened once per process, or None
+    when snapshots aren't configured, NumPy is missing or it isn't built yet
+    """
+    global _loaded_graph
+
+    path = settings.RECOMMEND_GRAPH_SNAPSHOT
+    if not path or np is None:
+        return None
+
+    if _loaded_graph is None or _loaded_graph.version != version:
+        try:
+            _loaded_graph = InteractionGraph.load(path, version)
+        except FileNotFoundError:
+            return None
+    return _loaded_graph
@@ -0,0 +1,33 @@
+"""
+Helpers shared by the populate commands to stream the filtered files into the
+database in fixed size batches.
+"""
+
+from itertools import islice
+
+from .json_backend import loads
+
+DEFAULT_BATCH_SIZE = 5000
+
+
+def read_batches(path, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Yield the decoded records of a JSON lines file, batch_size records at a
+    time, so only one batch is ever held in memory
+    """
+    # the lines are decoded straight from bytes, which orjson does fastest
+    with open(path, "rb") as file:
+        lines = (line for line in file if line.strip())
+        while batch := list(islice(lines, batch_size)):
+            yield [loads(line) for line in batch]
+
+
+def existing_ids(model, ids):
+    """
+    The ids out of the given ones that are already in the table of model,
+    used to resolve the foreign keys of a batch with a single query
+    """
+    ids = {obj_id for obj_id in ids if obj_id is not None}
+    if not ids:
+        return set()
+    return set(model.objects.filter(id__in=ids).values_list("id", flat=True))
@@ -0,0 +1,183 @@
+"""
+Per request timings of the ranking. A sampled request gets a RequestTimings
+that every query of its connection reports to, through an execute wrapper, and
+the code marks its stages with timed_stage. The wall time, number of queries
+and database time of every stage end up in the Server-Timing header of the
+response and in one JSON log line.
+
+Outside a sampled request timed_stage and instrumented only feed the latency
+histograms of recommend.metrics, so they are cheap enough to leave in the
+ranking code. The rate comes from the RECOMMEND_TIMING_SAMPLE_RATE setting.
+
+Async views are instrumented too. Their stages can run at the same time in
+worker threads: the current stage is a context variable, which every thread
+gets a copy of, and a stage reports the queries of the connection of the
+thread it runs in.
+"""
+
+import logging
+import random
+import threading
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import connection
+
+from .json_backend import dumps
+from .metrics import REQUEST_SECONDS, STAGE_SECONDS
+
+logger = logging.getLogger("recommend.timing")
+
+_current_timings = ContextVar("recommend_request_timings", default=None)
+_current_stage = ContextVar("recommend_timing_stage", default=None)
+
+
+class RequestTimings:
+    def __init__(self):
+        self.start = perf_counter()
+        # {stage: [wall time, queries, database time]} in the order they ran
+        self.stages = {}
+        self.queries = 0
+        self.db_time = 0.0
+        # the stages of an async view report from several threads
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = perf_counter() - start
+            name = _current_stage.get()
+            with self.lock:
+                self.queries += 1
+                self.db_time += elapsed
+                if name is not None:
+                    stage = self.stages[name]
+                    stage[1] += 1
+                    stage[2] += elapsed
+
+    def server_timing(self, total):
+        metrics = [
+            f"{name};dur={wall * 1000:.2f};"
+            f'desc="{queries} queries, {db * 1000:.2f}ms db"'
+            for name, (wall, queries, db) in self.stages.items()
+        ]
+        metrics.append(
+            f'db;dur={self.db_time * 1000:.2f};desc="{self.queries} queries"'
+        )
+        metrics.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(metrics)
+
+    def as_dict(self, total):
+        return {
+            "total_ms": round(total * 1000, 3),
+            "queries": self.queries,
+            "db_ms": round(self.db_time * 1000, 3),
+            "stages": {
+                name: {
+                    "wall_ms": round(wall * 1000, 3),
+                    "queries": queries,
+                    "db_ms": round(db * 1000, 3),
+                }
+                for name, (wall, queries, db) in self.stages.items()
+            },
+        }
+
+
+@contextmanager
+def timed_stage(name):
+    """
+    Attribute the time and the queries of the block to the stage name of the
+    current request, if it is sampled
+    """
+    timings = _current_timings.get()
+    with ExitStack() as stack:
+        if timings is not None:
+            with timings.lock:
+                timings.stages.setdefault(name, [0.0, 0, 0.0])
+            stack.callback(_current_stage.reset, _current_stage.set(name))
+            # a stage run in a worker thread queries on the connection of
+            # that thread
+            if timings not in connection.execute_wrappers:
+                stack.enter_context(connection.execute_wrapper(timings))
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            STAGE_SECONDS.observe(elapsed, stage=name)
+            if timings is not None:
+                with timings.lock:
+                    timings.stages[name][0] += elapsed
+
+
+def instrumented(view):
+    """
+    Time the requests of view, and their stages for a sampled share of them,
+    see the module docstring
+    """
+
+    # api_view wraps the function in a class named after it
+    name = getattr(view, "cls", view).__name__
+
+    def report(request, response, timings):
+        total = perf_counter() - timings.start
+        REQUEST_SECONDS.observe(total, view=name)
+        response["Server-Timing"] = timings.server_timing(total)
+        logger.info(
+            dumps(
+                {
+                    "path": request.path,
+                    "query": request.GET.urlencode(),
+                    "status": response.status_code,
+                    **timings.as_dict(total),
+                }
+            )
+        )
+        return response
+
+    if iscoroutinefunction(view):
+
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            if random.random() >= settings.RECOMMEND_TIMING_SAMPLE_RATE:
+                start = perf_counter()
+                response = await view(request, *args, **kwargs)
+                REQUEST_SECONDS.observe(perf_counter() - start, view=name)
+                return response
+
+            # the queries run in other threads, they are only counted in stages
+            timings = RequestTimings()
+            token = _current_timings.set(timings)
+            try:
+                response = await view(request, *args, **kwargs)
+            finally:
+                _current_timings.reset(token)
+            return report(request, response, timings)
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if random.random() >= settings.RECOMMEND_TIMING_SAMPLE_RATE:
+            start = perf_counter()
+            response = view(request, *args, **kwargs)
+            REQUEST_SECONDS.observe(perf_counter() - start, view=name)
+            return response
+
+        timings = RequestTimings()
+        token = _current_timings.set(timings)
+        try:
+            with connection.execute_wrapper(timings):
+                response = view(request, *args, **kwargs)
+        finally:
+            _current_timings.reset(token)
+        return report(request, response, timings)
+
+    return wrapper
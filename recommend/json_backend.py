@@ -0,0 +1,87 @@
+"""
+JSON backend of the ingest paths (the raw tweet filter and the populate
+commands). orjson is used when it's installed, the standard library json
+otherwise. RECOMMEND_JSON_BACKEND=json forces the standard library.
+
+Both backends accept the same documents: orjson is stricter than json (it
+rejects lone surrogates like "\\ud83d" or NaN), so what it rejects is decoded
+again by json, and what it can't encode is encoded by json. Which raw tweets
+the filter drops doesn't depend on orjson being installed.
+
+This module doesn't depend on Django so the filter script can use it too.
+"""
+
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError is a subclass of it
+JSONDecodeError = json.JSONDecodeError
+
+if orjson is not None and os.environ.get("RECOMMEND_JSON_BACKEND") != "json":
+    BACKEND = "orjson"
+
+    def loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # the rare lines orjson is stricter about
+            return json.loads(data)
+
+    def dumps(obj):
+        try:
+            return orjson.dumps(obj).decode()
+        except orjson.JSONEncodeError:
+            return json.dumps(obj)
+
+else:
+    BACKEND = "json"
+    loads = json.loads
+    dumps = json.dumps
+
+
+USER_FIELDS = ("id", "id_str", "screen_name", "description", "lang", "created_at")
+
+
+def project_user(user):
+    if user is None:
+        return None
+    return {field: user.get(field) for field in USER_FIELDS}
+
+
+def project_tweet(obj):
+    """
+    keep only the fields of a raw tweet the pipeline uses, so the rest of the
+    object can be freed right after decoding instead of being kept around and
+    pickled between processes
+    """
+    entities = obj.get("entities")
+    retweeted_status = obj.get("retweeted_status")
+
+    return {
+        "id": obj.get("id"),
+        "id_str": obj.get("id_str"),
+        "user": project_user(obj.get("user")),
+        "text": obj.get("text"),
+        "lang": obj.get("lang"),
+        "created_at": obj.get("created_at"),
+        "in_reply_to_user_id": obj.get("in_reply_to_user_id"),
+        "entities": entities
+        and {
+            "hashtags": entities.get("hashtags")
+            and [{"text": tag.get("text")} for tag in entities["hashtags"]]
+        },
+        "retweeted_status": retweeted_status and project_tweet(retweeted_status),
+    }
+
+
+def loads_tweet(line):
+    """
+    decode a raw tweet line and project it to the fields the pipeline uses
+    """
+    obj = loads(line)
+    return project_tweet(obj) if isinstance(obj, dict) else obj
@@ -0,0 +1,40 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from recommend.cache import get_dataset_version
+from recommend.graph import build_interaction_graph, np
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Write the interaction graph snapshot of the current dataset version"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--path",
+            default=settings.RECOMMEND_GRAPH_SNAPSHOT,
+            help="snapshot directory, RECOMMEND_GRAPH_SNAPSHOT by default",
+        )
+
+    def handle(self, *args, **kwargs):
+        if np is None:
+            raise CommandError("numpy is required to build the graph snapshot.")
+        if not kwargs["path"]:
+            raise CommandError("Set RECOMMEND_GRAPH_SNAPSHOT or pass --path.")
+
+        try:
+            start = time.perf_counter()
+            graph = build_interaction_graph(get_dataset_version())
+            target = graph.save(kwargs["path"])
+
+            elapsed = time.perf_counter() - start
+            logger.info(
+                f"Graph snapshot of version {graph.version} written to {target}, "
+                f"{len(graph.user_ids)} users and {len(graph)} edges in {elapsed:.1f}s."
+            )
+
+        except Exception as e:
+            logger.error(f"An error occurred: {e}")
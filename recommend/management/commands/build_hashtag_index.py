@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from recommend.cache import bump_dataset_version
+from recommend.derived import rebuild_hashtag_usage
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Build the hashtag usage index from the hashtags in the database"
+
+    def handle(self, *args, **kwargs):
+        try:
+            rows = rebuild_hashtag_usage()
+            logger.info(f"Hashtag index rebuilt with {rows} rows.")
+
+            version = bump_dataset_version()
+            logger.info(f"Dataset version bumped to {version}.")
+
+        except Exception as e:
+            logger.error(f"An error occurred: {e}")
@@ -0,0 +1,87 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from recommend.models import TweetUser
+from recommend.views import RankingScore, latest_contact_tweets_queryset
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SEQ_SCAN = "Seq Scan on"
+
+
+def scoring_querysets(scorer):
+    """
+    The queries a recommendation runs for the given scorer, in the order the
+    view runs them. The targets of the later queries come from the earlier ones
+    """
+    tags = dict(scorer.user_hashtags_queryset())
+    interactions = scorer.interaction_queryset()
+    target_user_ids = [row["user_b_id"] for row in interactions] or [scorer.user_id]
+
+    return [
+        ("interactions", scorer.interaction_queryset()),
+        ("user hashtags", scorer.user_hashtags_queryset()),
+        ("hashtag postings", scorer.hashtag_postings_queryset(list(tags))),
+        ("contact tweets", scorer.contact_tweets_queryset()),
+        (
+            "latest contact tweets",
+            latest_contact_tweets_queryset(scorer.user_id, target_user_ids),
+        ),
+    ]
+
+
+class Command(BaseCommand):
+    help = (
+        "Run EXPLAIN (ANALYZE, BUFFERS) on every scoring query for a sample user "
+        "and flag the sequential scans"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user-id",
+            type=int,
+            help="the user to explain, the one with the most tweets by default",
+        )
+        parser.add_argument(
+            "--type", default="both", choices=["reply", "retweet", "both"]
+        )
+        parser.add_argument("--phrase", default="hello")
+        parser.add_argument("--hashtag", default="")
+        parser.add_argument(
+            "--strict",
+            action="store_true",
+            help="fail when any plan has a sequential scan",
+        )
+
+    def handle(self, *args, **kwargs):
+        user_id = kwargs["user_id"]
+        if user_id is None:
+            user_id = (
+                TweetUser.objects.annotate(tweets=Count("tweet"))
+                .order_by("-tweets", "id")
+                .values_list("id", flat=True)
+                .first()
+            )
+        if user_id is None:
+            raise CommandError("There are no users to explain the queries for.")
+
+        scorer = RankingScore(
+            user_id, kwargs["type"], kwargs["phrase"], kwargs["hashtag"]
+        )
+        flagged = []
+        for name, queryset in scoring_querysets(scorer):
+            plan = queryset.explain(analyze=True, buffers=True)
+            seq_scans = [line.strip() for line in plan.splitlines() if SEQ_SCAN in line]
+            self.stdout.write(f"-- {name}\n{plan}\n")
+            if seq_scans:
+                flagged.append(name)
+                for line in seq_scans:
+                    logger.warning(f"Sequential scan in {name}: {line}")
+
+        logger.info(
+            f"Explained the scoring queries of user {user_id}, "
+            f"{len(flagged)} with a sequential scan."
+        )
+        if flagged and kwargs["strict"]:
+            raise CommandError(f"Sequential scans in: {', '.join(flagged)}")
@@ -0,0 +1,188 @@
+import time
+from django.core.management.base import BaseCommand
+from pathlib import Path
+from django.conf import settings
+from django.db import connection, transaction
+from recommend.cache import bump_dataset_version
+from recommend.derived import rebuild_hashtag_usage, rebuild_user_interactions
+from recommend.metrics import record_ingest
+from recommend.models import Hashtag, Tweet, TweetUser
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COPY_BLOCK_SIZE = 1 << 20
+
+# every line of the filtered files is copied as is into a jsonb column. the
+# quote and delimiter are set to bytes that can't be in a JSON line, so COPY
+# leaves the backslash escapes of the JSON alone
+COPY_SQL = (
+    "COPY {table} (doc) FROM STDIN (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')"
+)
+
+STAGING_TABLES = ("load_users", "load_tweets", "load_hashtags")
+
+# the same id can be in a file more than once, the last line wins like it
+# does with the populate commands
+USERS_SQL = """
+INSERT INTO {tweetuser} (id, screen_name, description, lang, created_at, updated_at)
+SELECT DISTINCT ON ((doc->>'id')::bigint)
+    (doc->>'id')::bigint,
+    doc->>'screen_name',
+    doc->>'description',
+    doc->>'lang',
+    (doc->>'created_at')::timestamptz,
+    (doc->>'updated_at')::timestamptz
+FROM load_users
+WHERE doc IS NOT NULL
+ORDER BY (doc->>'id')::bigint, line DESC
+ON CONFLICT (id) DO UPDATE SET
+    screen_name = EXCLUDED.screen_name,
+    description = EXCLUDED.description,
+    lang = EXCLUDED.lang,
+    created_at = EXCLUDED.created_at,
+    updated_at = EXCLUDED.updated_at
+"""
+
+TWEET_ROWS_SQL = """
+CREATE TEMP TABLE load_tweet_rows AS
+SELECT DISTINCT ON ((doc->>'id')::bigint)
+    (doc->>'id')::bigint AS id,
+    (doc->>'user')::bigint AS user_id,
+    doc->>'text' AS text,
+    (doc->>'reply_to_user')::bigint AS reply_to_user_id,
+    (doc->>'retweet')::bigint AS retweet_id,
+    doc->>'lang' AS lang,
+    (doc->>'created_at')::timestamptz AS created_at
+FROM load_tweets
+WHERE doc IS NOT NULL
+ORDER BY (doc->>'id')::bigint, line DESC
+"""
+
+# tweets of unknown users are dropped and unknown reply users are nulled. the
+# retweets are left out here since they can point to any row of the file
+TWEETS_SQL = """
+INSERT INTO {tweet} (id, user_id, text, reply_to_user_id, retweet_id, lang, created_at)
+SELECT s.id, s.user_id, s.text, u.id, NULL, s.lang, s.created_at
+FROM load_tweet_rows s
+JOIN {tweetuser} author ON author.id = s.user_id
+LEFT JOIN {tweetuser} u ON u.id = s.reply_to_user_id
+ON CONFLICT (id) DO UPDATE SET
+    user_id = EXCLUDED.user_id,
+    text = EXCLUDED.text,
+    reply_to_user_id = EXCLUDED.reply_to_user_id,
+    retweet_id = NULL,
+    lang = EXCLUDED.lang,
+    created_at = EXCLUDED.created_at
+"""
+
+RETWEETS_SQL = """
+UPDATE {tweet} t
+SET retweet_id = s.retweet_id
+FROM load_tweet_rows s
+JOIN {tweet} r ON r.id = s.retweet_id
+WHERE t.id = s.id
+"""
+
+HASHTAGS_SQL = """
+INSERT INTO {hashtag} (user_id, tweet_id, text, is_popular)
+SELECT u.id, t.id, h.doc->>'text', FALSE
+FROM load_hashtags h
+JOIN {tweetuser} u ON u.id = (h.doc->>'user')::bigint
+JOIN {tweet} t ON t.id = (h.doc->>'tweet')::bigint
+WHERE h.doc IS NOT NULL
+ON CONFLICT (user_id, tweet_id, text) DO NOTHING
+"""
+
+
+class Command(BaseCommand):
+    help = "Load the filtered files into the database with COPY, for full reloads"
+
+    def add_arguments(self, parser):
+        base_path = Path(settings.BASE_DIR)
+        parser.add_argument("--users", default=base_path / "filtered/valid_usr_obj.txt")
+        parser.add_argument(
+            "--tweets", default=base_path / "filtered/valid_tweet_objects.txt"
+        )
+        parser.add_argument(
+            "--hashtags", default=base_path / "filtered/valid_hashtags.txt"
+        )
+
+    def phase(self, name, func):
+        start = time.perf_counter()
+        rows = func()
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"{name}: {rows} rows in {elapsed:.1f}s "
+            f"({rows / max(elapsed, 1e-9):.0f} rows/s)."
+        )
+        return rows
+
+    def copy_file(self, cursor, table, path):
+        def copy():
+            with (
+                open(path, "rb") as file,
+                cursor.copy(COPY_SQL.format(table=table)) as copy,
+            ):
+                while block := file.read(COPY_BLOCK_SIZE):
+                    copy.write(block)
+            cursor.execute(f"ANALYZE {table}")
+            cursor.execute(f"SELECT COUNT(*) FROM {table}")
+            return cursor.fetchone()[0]
+
+        return self.phase(f"Copied {path}", copy)
+
+    def run_sql(self, cursor, name, sql):
+        def run():
+            cursor.execute(
+                sql.format(
+                    tweetuser=TweetUser._meta.db_table,
+                    tweet=Tweet._meta.db_table,
+                    hashtag=Hashtag._meta.db_table,
+                )
+            )
+            return cursor.rowcount
+
+        return self.phase(name, run)
+
+    def handle(self, *args, **kwargs):
+        try:
+            start = time.perf_counter()
+
+            with transaction.atomic(), connection.cursor() as cursor:
+                for table in STAGING_TABLES:
+                    cursor.execute(
+                        f"CREATE TEMP TABLE {table} (line bigserial, doc jsonb)"
+                    )
+
+                records = self.copy_file(cursor, "load_users", kwargs["users"])
+                records += self.copy_file(cursor, "load_tweets", kwargs["tweets"])
+                records += self.copy_file(cursor, "load_hashtags", kwargs["hashtags"])
+
+                # users, then tweets, then the retweets between them and the
+                # hashtags last, so every foreign key has its row
+                self.run_sql(cursor, "Merged users", USERS_SQL)
+                self.run_sql(cursor, "Staged tweets", TWEET_ROWS_SQL)
+                self.run_sql(cursor, "Merged tweets", TWEETS_SQL)
+                self.run_sql(cursor, "Linked retweets", RETWEETS_SQL)
+                self.run_sql(cursor, "Merged hashtags", HASHTAGS_SQL)
+
+                # dropped here rather than on commit, in case the command runs
+                # inside a bigger transaction
+                cursor.execute(
+                    f"DROP TABLE {', '.join(STAGING_TABLES)}, load_tweet_rows"
+                )
+
+                self.phase("Rebuilt user interactions", rebuild_user_interactions)
+                self.phase("Rebuilt hashtag index", rebuild_hashtag_usage)
+
+            record_ingest("load_dataset", records, time.perf_counter() - start)
+            version = bump_dataset_version()
+            logger.info(
+                f"Dataset loaded in {time.perf_counter() - start:.1f}s, "
+                f"version bumped to {version}."
+            )
+
+        except Exception as e:
+            logger.error(f"An error occurred: {e}")
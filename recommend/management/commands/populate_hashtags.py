@@ -1,10 +1,11 @@
-import json
-import os
-from datetime import datetime
+import time
 from django.core.management.base import BaseCommand
 from pathlib import Path
 from django.conf import settings
-from multiprocessing import Pool
+from recommend.cache import bump_dataset_version
+from recommend.derived import rebuild_hashtag_usage
+from recommend.ingest import DEFAULT_BATCH_SIZE, existing_ids, read_batches
+from recommend.metrics import record_ingest
 from recommend.models import Tweet, TweetUser, Hashtag
 from django.db import transaction
 import logging
@@ -14,45 +15,54 @@ logger = logging.getLogger(__name__)
 
 
 def process_hashtag_batch(hashtags):
-    with transaction.atomic():
-        for tag in hashtags:
-            user_id = tag.pop("user", None)
-            tweet_id = tag.pop("tweet", None)
+    users = existing_ids(TweetUser, [tag.get("user") for tag in hashtags])
+    tweets = existing_ids(Tweet, [tag.get("tweet") for tag in hashtags])
 
-            user = TweetUser.objects.filter(id=user_id).first() if user_id else None
-            tweet = Tweet.objects.filter(id=tweet_id).first() if tweet_id else None
+    hashtag_objs = [
+        Hashtag(
+            user_id=tag.get("user"), tweet_id=tag.get("tweet"), text=tag.get("text")
+        )
+        for tag in hashtags
+        if tag.get("user") in users and tag.get("tweet") in tweets
+    ]
 
-            if user and tweet:
-                Hashtag.objects.get_or_create(
-                    user=user, tweet=tweet, defaults={"text": tag.get("text")}
-                )
-                logger.info(
-                    f"Processed hashtag for user {user_id} and tweet {tweet_id}"
-                )
+    # (user, tweet, text) is unique, hashtags already loaded are left as is
+    with transaction.atomic():
+        Hashtag.objects.bulk_create(hashtag_objs, ignore_conflicts=True)
+    return len(hashtag_objs)
 
 
 class Command(BaseCommand):
     help = "Import tweets from a file to the database"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+
     def handle(self, *args, **kwargs):
         base_path = Path(settings.BASE_DIR)
         input_file_path = base_path / "filtered/valid_hashtags.txt"
 
         try:
-            with open(input_file_path, "r") as file:
-                hashtags = [json.loads(line.strip()) for line in file]
+            start = time.perf_counter()
+            total = 0
+            for hashtags in read_batches(input_file_path, kwargs["batch_size"]):
+                total += process_hashtag_batch(hashtags)
+                logger.info(f"Processed {total} hashtags.")
 
-            num_processes = os.cpu_count() or 4
-            chunk_size = max(1, len(hashtags) // num_processes)
-            chunks = [
-                hashtags[i : i + chunk_size]
-                for i in range(0, len(hashtags), chunk_size)
-            ]
+            elapsed = time.perf_counter() - start
+            record_ingest("populate_hashtags", total, elapsed)
+            logger.info(
+                f"All hashtags processed successfully, {total} hashtags in "
+                f"{elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f}/s)."
+            )
 
-            with Pool(processes=num_processes) as pool:
-                pool.map(process_hashtag_batch, chunks)
+            # popular hashtags are left out of the index, so it is rebuilt
+            # whenever the hashtags change
+            rows = rebuild_hashtag_usage()
+            logger.info(f"Hashtag index rebuilt with {rows} rows.")
 
-            logger.info("All hashtags processed successfully.")
+            version = bump_dataset_version()
+            logger.info(f"Dataset version bumped to {version}.")
 
         except Exception as e:
             logger.error(f"An error occurred: {e}")
@@ -1,11 +1,13 @@
-import json
-import os
-from datetime import datetime
+import time
 from django.core.management.base import BaseCommand
 from pathlib import Path
 from django.conf import settings
-from multiprocessing import Pool
+from recommend.cache import bump_dataset_version
+from recommend.derived import rebuild_user_interactions
+from recommend.ingest import DEFAULT_BATCH_SIZE, existing_ids, read_batches
+from recommend.metrics import record_ingest
 from recommend.models import Tweet, TweetUser
+from recommend.timestamps import parse_twitter_datetime
 from django.db import transaction
 import logging
 
@@ -13,57 +15,88 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def parse_datetime(datetime_str):
-    return datetime.strptime(datetime_str, "%a %b %d %H:%M:%S %z %Y")
-
-
 def process_tweet_batch(tweets):
-    with transaction.atomic():
-        for twt in tweets:
-            if twt.get("created_at"):
-                twt["created_at"] = parse_datetime(twt.get("created_at"))
-
-            user_id = twt.pop("user", None)
-            reply_to_usr = twt.pop("reply_to_user", None)
-            retweet = twt.pop("retweet", None)
-
-            twt["user"] = (
-                TweetUser.objects.filter(id=user_id).first() if user_id else None
-            )
-            twt["reply_to_user"] = (
-                TweetUser.objects.filter(id=reply_to_usr).first()
-                if reply_to_usr
-                else None
-            )
-            twt["retweet"] = (
-                Tweet.objects.filter(id=retweet).first() if retweet else None
-            )
+    # foreign keys are resolved for the whole batch at once, the ones that
+    # aren't in the database are dropped like before. the tweets of the batch
+    # itself can be retweeted since the FK checks are deferred to the commit
+    users = existing_ids(
+        TweetUser,
+        [twt.get("user") for twt in tweets]
+        + [twt.get("reply_to_user") for twt in tweets],
+    )
+    retweets = existing_ids(Tweet, [twt.get("retweet") for twt in tweets])
+
+    tweet_objs = {}
+    for twt in tweets:
+        if twt.get("user") not in users:
+            continue
+
+        if twt.get("created_at"):
+            twt["created_at"] = parse_twitter_datetime(twt.get("created_at"))
+
+        reply_to_usr = twt.get("reply_to_user")
+
+        tweet_objs[twt.get("id")] = Tweet(
+            id=twt.get("id"),
+            user_id=twt.get("user"),
+            text=twt.get("text"),
+            reply_to_user_id=reply_to_usr if reply_to_usr in users else None,
+            retweet_id=twt.get("retweet"),
+            lang=twt.get("lang"),
+            created_at=twt.get("created_at"),
+        )
+
+    for tweet in tweet_objs.values():
+        if tweet.retweet_id not in retweets and tweet.retweet_id not in tweet_objs:
+            tweet.retweet_id = None
 
-            Tweet.objects.update_or_create(id=twt.get("id"), defaults=twt)
-            logger.info(f"Processed tweet ID: {twt.get('id')}")
+    with transaction.atomic():
+        Tweet.objects.bulk_create(
+            tweet_objs.values(),
+            update_conflicts=True,
+            unique_fields=["id"],
+            update_fields=[
+                "user",
+                "text",
+                "reply_to_user",
+                "retweet",
+                "lang",
+                "created_at",
+            ],
+        )
+    return len(tweet_objs)
 
 
 class Command(BaseCommand):
     help = "Import tweets from a file to the database"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+
     def handle(self, *args, **kwargs):
         base_path = Path(settings.BASE_DIR)
         input_file_path = base_path / "filtered/valid_tweet_objects.txt"
 
         try:
-            with open(input_file_path, "r") as file:
-                tweets = [json.loads(line.strip()) for line in file]
-
-            num_processes = os.cpu_count() or 4
-            chunk_size = max(1, len(tweets) // num_processes)
-            chunks = [
-                tweets[i : i + chunk_size] for i in range(0, len(tweets), chunk_size)
-            ]
+            start = time.perf_counter()
+            total = 0
+            for tweets in read_batches(input_file_path, kwargs["batch_size"]):
+                total += process_tweet_batch(tweets)
+                logger.info(f"Processed {total} tweets.")
+
+            elapsed = time.perf_counter() - start
+            record_ingest("populate_tweets", total, elapsed)
+            logger.info(
+                f"All tweets processed successfully, {total} tweets in "
+                f"{elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f}/s)."
+            )
 
-            with Pool(processes=num_processes) as pool:
-                pool.map(process_tweet_batch, chunks)
+            # keep the derived interaction table in line with the new tweets
+            rows = rebuild_user_interactions()
+            logger.info(f"User interactions rebuilt with {rows} rows.")
 
-            logger.info("All tweets processed successfully.")
+            version = bump_dataset_version()
+            logger.info(f"Dataset version bumped to {version}.")
 
         except Exception as e:
             logger.error(f"An error occurred: {e}")
@@ -1,11 +1,12 @@
-import json
-import os
-from datetime import datetime
+import time
 from django.core.management.base import BaseCommand
 from pathlib import Path
 from django.conf import settings
-from multiprocessing import Pool
+from recommend.cache import bump_dataset_version
+from recommend.ingest import DEFAULT_BATCH_SIZE, read_batches
+from recommend.metrics import record_ingest
 from recommend.models import TweetUser
+from recommend.timestamps import parse_twitter_datetime
 from django.db import transaction
 import logging
 
@@ -13,44 +14,60 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def parse_datetime(datetime_str):
-    return datetime.strptime(datetime_str, "%a %b %d %H:%M:%S %z %Y")
-
-
 def process_user_batch(users):
-    with transaction.atomic():
-        for usr in users:
-            if usr.get("created_at"):
-                usr["created_at"] = parse_datetime(usr["created_at"])
+    # the same user can be in the file more than once, the last one wins
+    user_objs = {}
+    for usr in users:
+        if usr.get("created_at"):
+            usr["created_at"] = parse_twitter_datetime(usr["created_at"])
 
-            if usr.get("updated_at"):
-                usr["updated_at"] = parse_datetime(usr["updated_at"])
+        if usr.get("updated_at"):
+            usr["updated_at"] = parse_twitter_datetime(usr["updated_at"])
 
-            TweetUser.objects.update_or_create(id=usr.get("id"), defaults=usr)
-            logger.info(f"Processed user ID: {usr.get('id')}")
+        user_objs[usr.get("id")] = TweetUser(**usr)
+
+    with transaction.atomic():
+        TweetUser.objects.bulk_create(
+            user_objs.values(),
+            update_conflicts=True,
+            unique_fields=["id"],
+            update_fields=[
+                "screen_name",
+                "description",
+                "lang",
+                "created_at",
+                "updated_at",
+            ],
+        )
+    return len(user_objs)
 
 
 class Command(BaseCommand):
     help = "Import users from a file to the database"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+
     def handle(self, *args, **kwargs):
         base_path = Path(settings.BASE_DIR)
         input_file_path = base_path / "filtered/valid_usr_obj.txt"
 
         try:
-            with open(input_file_path, "r") as file:
-                users = [json.loads(line.strip()) for line in file]
-
-            num_processes = os.cpu_count() or 4
-            chunk_size = max(1, len(users) // num_processes)
-            chunks = [
-                users[i : i + chunk_size] for i in range(0, len(users), chunk_size)
-            ]
+            start = time.perf_counter()
+            total = 0
+            for users in read_batches(input_file_path, kwargs["batch_size"]):
+                total += process_user_batch(users)
+                logger.info(f"Processed {total} users.")
 
-            with Pool(processes=num_processes) as pool:
-                pool.map(process_user_batch, chunks)
+            elapsed = time.perf_counter() - start
+            record_ingest("populate_users", total, elapsed)
+            logger.info(
+                f"All users processed successfully, {total} users in "
+                f"{elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f}/s)."
+            )
 
-            logger.info("All users processed successfully.")
+            version = bump_dataset_version()
+            logger.info(f"Dataset version bumped to {version}.")
 
         except Exception as e:
             logger.error(f"An error occurred: {e}")
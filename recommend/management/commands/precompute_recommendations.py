@@ -0,0 +1,101 @@
+import os
+import time
+from contextlib import nullcontext
+from multiprocessing import Pool
+from pathlib import Path
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+from recommend.cache import get_dataset_version
+from recommend.json_backend import dumps
+from recommend.models import TweetUser
+from recommend.views import BatchRankingScore
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def init_worker():
+    # a no-op for forked workers, spawned ones have to set Django up first
+    django.setup()
+
+
+def rank_chunk(args):
+    user_ids, query_type, phrase, hashtag, limit = args
+    rankings = BatchRankingScore(
+        user_ids, query_type, phrase, hashtag
+    ).calculate_final_scores(limit=limit)
+    return list(rankings.items())
+
+
+class Command(BaseCommand):
+    help = (
+        "Rank every user for the given type, phrase and hashtag over a process "
+        "pool and write the rankings to a JSON lines file"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", type=Path)
+        parser.add_argument(
+            "--type", default="both", choices=["reply", "retweet", "both"]
+        )
+        parser.add_argument("--phrase", default="")
+        parser.add_argument("--hashtag", default=None)
+        parser.add_argument("--limit", type=int, default=None)
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument("--processes", type=int, default=os.cpu_count() or 4)
+
+    def handle(self, *args, **kwargs):
+        try:
+            start = time.perf_counter()
+            version = get_dataset_version()
+            user_ids = list(
+                TweetUser.objects.order_by("id").values_list("id", flat=True)
+            )
+            chunk_size = kwargs["chunk_size"]
+            chunks = [
+                (
+                    user_ids[index : index + chunk_size],
+                    kwargs["type"],
+                    kwargs["phrase"],
+                    kwargs["hashtag"],
+                    kwargs["limit"],
+                )
+                for index in range(0, len(user_ids), chunk_size)
+            ]
+
+            output = kwargs["output"]
+            output.parent.mkdir(parents=True, exist_ok=True)
+            total = 0
+            if kwargs["processes"] > 1:
+                # the workers can't share the connection of this process, nor
+                # its pool, whose threads don't survive the fork
+                connections.close_all()
+                for conn in connections.all():
+                    conn.close_pool()
+                pool = Pool(kwargs["processes"], initializer=init_worker)
+            else:
+                pool = None
+
+            with open(output, "w") as file, pool or nullcontext():
+                results = (pool.imap if pool else map)(rank_chunk, chunks)
+                for rankings in results:
+                    for user_id, final_scores in rankings:
+                        record = {
+                            "user_id": user_id,
+                            "version": version,
+                            "recommendations": final_scores,
+                        }
+                        file.write(dumps(record) + "\n")
+                    total += len(rankings)
+                    logger.info(f"Ranked {total} of {len(user_ids)} users.")
+
+            elapsed = time.perf_counter() - start
+            logger.info(
+                f"Recommendations of {total} users written to {output} in "
+                f"{elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f}/s)."
+            )
+
+        except Exception as e:
+            logger.error(f"An error occurred: {e}")
@@ -0,0 +1,122 @@
+import os
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, connections
+from django.urls import get_resolver
+from gunicorn.app.base import BaseApplication
+from recommend.cache import get_dataset_version
+from recommend.graph import get_interaction_graph
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ASGI_WORKER = "uvicorn_worker.UvicornWorker"
+
+
+def default_workers():
+    return int(os.environ.get("WEB_CONCURRENCY", 2 * (os.cpu_count() or 1) + 1))
+
+
+def warm_up_master():
+    """
+    Everything the workers can share, done once before they are forked: the
+    URL patterns are compiled and the graph snapshot is mapped
+    """
+    get_resolver().resolve("/q2")
+    version = get_dataset_version()
+    graph = get_interaction_graph(version)
+    # a connection can't be shared by the forked workers, nor a pool and its
+    # threads
+    connections.close_all()
+    for conn in connections.all():
+        conn.close_pool()
+    logger.info(
+        f"Warmed up on dataset version {version}, "
+        f"graph snapshot {'loaded' if graph is not None else 'not used'}."
+    )
+
+
+def warm_up_worker(server, worker):
+    """
+    gunicorn post_fork hook, run in every new worker before it accepts
+    requests: with POSTGRES_POOL it fills the worker's own pool, and it maps the
+    graph snapshot again if the dataset changed since the master warmed up.
+    Without a pool the connections are opened per request anyway
+    """
+    if connection.pool is not None:
+        connection.pool.open(wait=True)
+    get_interaction_graph(get_dataset_version())
+    # the connection of this thread goes back to the pool, the requests may run
+    # in other threads
+    connections.close_all()
+
+
+class Application(BaseApplication):
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve the application with gunicorn, the application is loaded once and "
+        "warmed up before the workers are forked"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bind", default="0.0.0.0:8000")
+        parser.add_argument("--workers", type=int, default=default_workers())
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=1,
+            help="threads per worker, more than 1 serves keep-alive connections",
+        )
+        parser.add_argument("--keep-alive", type=int, default=5)
+        parser.add_argument(
+            "--max-requests",
+            type=int,
+            default=1000,
+            help="requests before a worker is replaced, 0 to never replace them",
+        )
+        parser.add_argument("--max-requests-jitter", type=int, default=100)
+        parser.add_argument("--timeout", type=int, default=30)
+        parser.add_argument(
+            "--asgi",
+            action="store_true",
+            help="serve the ASGI application with uvicorn workers",
+        )
+
+    def gunicorn_options(self, kwargs):
+        options = {
+            "bind": kwargs["bind"],
+            "workers": kwargs["workers"],
+            "threads": kwargs["threads"],
+            "keepalive": kwargs["keep_alive"],
+            "max_requests": kwargs["max_requests"],
+            "max_requests_jitter": kwargs["max_requests_jitter"],
+            "timeout": kwargs["timeout"],
+            "preload_app": True,
+            "post_fork": warm_up_worker,
+            "accesslog": "-",
+        }
+        if kwargs["asgi"]:
+            options["worker_class"] = ASGI_WORKER
+        return options
+
+    def handle(self, *args, **kwargs):
+        application = (
+            get_asgi_application() if kwargs["asgi"] else get_wsgi_application()
+        )
+        warm_up_master()
+        Application(application, self.gunicorn_options(kwargs)).run()
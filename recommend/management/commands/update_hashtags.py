@@ -3,6 +3,8 @@ from django.core.management.base import BaseCommand
 from pathlib import Path
 from django.conf import settings
 from multiprocessing import Pool, cpu_count
+from recommend.cache import bump_dataset_version
+from recommend.derived import rebuild_hashtag_usage
 from recommend.models import Hashtag
 from django.db import transaction
 import logging
@@ -46,5 +48,13 @@ class Command(BaseCommand):
 
             logger.info("All hashtags processed successfully.")
 
+            # popular hashtags are left out of the index, so it is rebuilt
+            # whenever the hashtags change
+            rows = rebuild_hashtag_usage()
+            logger.info(f"Hashtag index rebuilt with {rows} rows.")
+
+            version = bump_dataset_version()
+            logger.info(f"Dataset version bumped to {version}.")
+
         except Exception as e:
             logger.error(f"An error occurred: {e}")
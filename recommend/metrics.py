@@ -0,0 +1,357 @@
+"""
+In-process metrics registry, exposed in the Prometheus text format by the
+/metrics view. Only counters and histograms are kept, both can be summed
+across processes.
+
+Every process keeps its own values. With RECOMMEND_METRICS_DIR set, a process
+also writes them to <pid>-<nonce>.json in that directory, at most once a second
+and when it exits, and /metrics sums the files of every process. The values of
+the other processes can be a second old. A forked child starts from zero with
+a file of its own, the values it inherits are still counted by its parent.
+
+The files of the processes that are gone, or whose pid was taken by a new
+process, are folded into merged.json the first time a process writes its own,
+so the totals never go down and the directory doesn't grow with every worker
+ever started. The folding and the reads of /metrics hold a lock on the
+directory, so no file is ever counted twice or missed.
+"""
+
+import atexit
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from time import monotonic
+from uuid import uuid4
+
+from django.conf import settings
+
+from .json_backend import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 1.0
+MERGED_FILE = "merged.json"
+LOCK_FILE = ".lock"
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, registry, name, documentation, labelnames):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def key(self, labels):
+        return (self.name, tuple(str(labels[label]) for label in self.labelnames))
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        self.registry.update(self.key(labels), lambda value: (value or 0) + amount)
+
+    def samples(self, labels, value):
+        yield self.name, labels, value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, registry, name, documentation, labelnames, buckets):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, amount, **labels):
+        index = bisect_left(self.buckets, amount)
+
+        def add(value):
+            # the count of every bucket (the last one is +Inf), then the sum
+            value = value or [0] * (len(self.buckets) + 2)
+            value[index] += 1
+            value[-1] += amount
+            return value
+
+        self.registry.update(self.key(labels), add)
+
+    def samples(self, labels, value):
+        cumulative = 0
+        for bound, count in zip(
+            (*map(float, self.buckets), "+Inf"), value[:-1], strict=True
+        ):
+            cumulative += count
+            yield (
+                f"{self.name}_bucket",
+                (*labels, ("le", format_value(bound))),
+                cumulative,
+            )
+        yield f"{self.name}_sum", labels, value[-1]
+        yield f"{self.name}_count", labels, cumulative
+
+
+def merge(value, other):
+    if isinstance(value, list):
+        return [a + b for a, b in zip(value, other, strict=True)]
+    return value + other
+
+
+def merge_entries(values, entries):
+    for name, labels, value in entries:
+        key = (name, tuple(labels))
+        values[key] = merge(values[key], value) if key in values else value
+
+
+def as_entries(values):
+    return [[name, labels, value] for (name, labels), value in values.items()]
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def format_value(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Registry:
+    def __init__(self, directory=None):
+        self.directory = Path(directory) if directory else None
+        self.metrics = {}
+        # {(metric name, label values): number, or bucket counts and sum}
+        self.values = {}
+        self.lock = threading.Lock()
+        # one flush at a time, so an older snapshot never replaces a newer one
+        self.flush_lock = threading.Lock()
+        self._start()
+        if self.directory is not None:
+            os.register_at_fork(after_in_child=self._reset)
+            atexit.register(self.flush)
+
+    @classmethod
+    def from_settings(cls):
+        return cls(getattr(settings, "RECOMMEND_METRICS_DIR", None))
+
+    def _start(self):
+        self.last_flush = monotonic()
+        # a new process can get the pid of one that is gone, the nonce keeps
+        # their files apart
+        self.filename = f"{os.getpid()}-{uuid4().hex[:12]}.json"
+        self.compacted = False
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.values = {}
+        self._start()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def update(self, key, func):
+        with self.lock:
+            self.values[key] = func(self.values.get(key))
+            due = (
+                self.directory is not None
+                and monotonic() - self.last_flush > FLUSH_INTERVAL
+            )
+            if due:
+                self.last_flush = monotonic()
+        if due:
+            self.flush()
+
+    @contextmanager
+    def directory_lock(self, operation):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / LOCK_FILE, "a") as file:
+            fcntl.flock(file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def flush(self):
+        """
+        Write the values of this process to its file, renamed into place so
+        readers never see half of it. A failure is logged, never raised to the
+        code that is being measured
+        """
+        if self.directory is None:
+            return
+        try:
+            with self.flush_lock:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                if not self.compacted:
+                    self.compact()
+                    self.compacted = True
+                with self.lock:
+                    self.last_flush = monotonic()
+                    data = dumps(as_entries(self.values))
+                self.write(self.filename, data)
+        except Exception:
+            logger.exception("Could not write the metrics of this process.")
+
+    def write(self, filename, data):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(data)
+            os.replace(tmp, self.directory / filename)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+    def read(self, path):
+        try:
+            return loads(path.read_text())
+        except FileNotFoundError:
+            return []
+        except ValueError:
+            logger.warning(f"Ignoring the unreadable metrics file {path}.")
+            return []
+
+    def compact(self):
+        """
+        Fold the files of the processes that are gone into merged.json
+        """
+        with self.directory_lock(fcntl.LOCK_EX):
+            dead = []
+            for path in self.directory.glob("*-*.json"):
+                pid = int(path.name.split("-", 1)[0])
+                if path.name == self.filename:
+                    continue
+                # a file with our pid is from a process that is gone
+                if pid == os.getpid() or not process_alive(pid):
+                    dead.append(path)
+            if not dead:
+                return
+
+            merged = {}
+            merge_entries(merged, self.read(self.directory / MERGED_FILE))
+            for path in dead:
+                merge_entries(merged, self.read(path))
+            self.write(MERGED_FILE, dumps(as_entries(merged)))
+            for path in dead:
+                path.unlink(missing_ok=True)
+
+    def collect(self):
+        """
+        The values of this process, summed with the files of the others
+        """
+        with self.lock:
+            values = {
+                key: value[:] if isinstance(value, list) else value
+                for key, value in self.values.items()
+            }
+        if self.directory is None:
+            return values
+
+        with self.directory_lock(fcntl.LOCK_SH):
+            for path in self.directory.glob("*.json"):
+                if path.name != self.filename:
+                    merge_entries(values, self.read(path))
+        return values
+
+    def exposition(self):
+        """
+        The Prometheus text format of all the metrics
+        """
+        series = {}
+        for (name, labels), value in sorted(self.collect().items()):
+            series.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for labels, value in series.get(name, []):
+                labels = tuple(zip(metric.labelnames, labels, strict=True))
+                for sample, sample_labels, sample_value in metric.samples(
+                    labels, value
+                ):
+                    label_text = ",".join(
+                        f'{label}="{escape(text)}"' for label, text in sample_labels
+                    )
+                    label_text = f"{{{label_text}}}" if label_text else ""
+                    lines.append(f"{sample}{label_text} {format_value(sample_value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry.from_settings()
+
+REQUEST_SECONDS = registry.histogram(
+    "recommend_request_seconds", "Latency of the recommendation views.", ["view"]
+)
+STAGE_SECONDS = registry.histogram(
+    "recommend_stage_seconds", "Latency of the ranking stages.", ["stage"]
+)
+CANDIDATES_SCORED = registry.counter(
+    "recommend_candidates_scored_total",
+    "Stage scores combined by the ranking, one per candidate user and stage.",
+)
+ROWS_FETCHED = registry.counter(
+    "recommend_rows_fetched_total",
+    "Rows read from the database by the ranking stages.",
+    ["stage"],
+)
+CACHE_LOOKUPS = registry.counter(
+    "recommend_cache_lookups_total",
+    "Lookups of the recommendation cache, by result.",
+    ["result"],
+)
+INGEST_ROWS = registry.counter(
+    "recommend_ingest_rows_total",
+    "Records imported by the ingest commands.",
+    ["command"],
+)
+INGEST_SECONDS = registry.counter(
+    "recommend_ingest_seconds_total",
+    "Time spent importing by the ingest commands.",
+    ["command"],
+)
+
+
+def record_ingest(command, rows, elapsed):
+    INGEST_ROWS.inc(rows, command=command)
+    INGEST_SECONDS.inc(elapsed, command=command)
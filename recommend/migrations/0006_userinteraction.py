@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommend', '0005_alter_hashtag_unique_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserInteraction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reply_count', models.PositiveIntegerField(default=0)),
+                ('retweet_count', models.PositiveIntegerField(default=0)),
+                ('user_a', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='interactions', to='recommend.tweetuser')),
+                ('user_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='recommend.tweetuser')),
+            ],
+            options={
+                'unique_together': {('user_a', 'user_b')},
+            },
+        ),
+    ]
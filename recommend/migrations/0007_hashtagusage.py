@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommend', '0006_userinteraction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HashtagUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tag', models.CharField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hashtag_usage', to='recommend.tweetuser')),
+            ],
+            options={
+                'unique_together': {('tag', 'user')},
+            },
+        ),
+    ]
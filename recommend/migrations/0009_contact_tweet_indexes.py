@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:03
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the indexes are built without locking the tweet table against writes
+    atomic = False
+
+    dependencies = [
+        ('recommend', '0008_datasetversion'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='hashtag',
+            index=models.Index(fields=['tweet', 'text'], name='hashtag_tweet_text_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='tweet',
+            index=models.Index(condition=models.Q(('lang__in', ['ar', 'en', 'fr', 'in', 'pt', 'es', 'tr', 'ja'])), fields=['user', '-created_at', '-id'], name='tweet_valid_user_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='tweet',
+            index=models.Index(condition=models.Q(('lang__in', ['ar', 'en', 'fr', 'in', 'pt', 'es', 'tr', 'ja']), ('reply_to_user__isnull', False)), fields=['reply_to_user', 'user', '-created_at', '-id'], name='tweet_valid_reply_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='tweet',
+            index=models.Index(condition=models.Q(('lang__in', ['ar', 'en', 'fr', 'in', 'pt', 'es', 'tr', 'ja']), ('retweet__isnull', False)), fields=['retweet', 'user', '-created_at', '-id'], name='tweet_valid_retweet_idx'),
+        ),
+    ]
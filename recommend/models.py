@@ -5,10 +5,16 @@ from django.db.models import (
     CharField,
     DateTimeField,
     ForeignKey,
+    Index,
     Model,
+    PositiveBigIntegerField,
+    PositiveIntegerField,
+    Q,
     TextField,
 )
 
+valid_languages = ["ar", "en", "fr", "in", "pt", "es", "tr", "ja"]
+
 
 # Create your models here.
 class TweetUser(Model):
@@ -38,6 +44,28 @@ class Tweet(Model):
     lang = CharField(max_length=10)
     created_at = DateTimeField()
 
+    class Meta:
+        # partial indexes for the contact tweet queries of the ranking, which
+        # only ever look at the valid languages. The trailing created_at and id
+        # give the latest contact tweet of every user straight from the index
+        indexes = [
+            Index(
+                fields=["user", "-created_at", "-id"],
+                name="tweet_valid_user_idx",
+                condition=Q(lang__in=valid_languages),
+            ),
+            Index(
+                fields=["reply_to_user", "user", "-created_at", "-id"],
+                name="tweet_valid_reply_idx",
+                condition=Q(lang__in=valid_languages, reply_to_user__isnull=False),
+            ),
+            Index(
+                fields=["retweet", "user", "-created_at", "-id"],
+                name="tweet_valid_retweet_idx",
+                condition=Q(lang__in=valid_languages, retweet__isnull=False),
+            ),
+        ]
+
     def __str__(self):
         return self.text
 
@@ -51,6 +79,61 @@ class Hashtag(Model):
     class Meta:
         # to ensure uniqueness and avoid overiding case of multiple hashtags on the same tweet
         unique_together = ("user", "tweet", "text")
+        # the keyword scores count the matching hashtags of every contact tweet,
+        # with the text in the index that join never has to visit the table
+        indexes = [Index(fields=["tweet", "text"], name="hashtag_tweet_text_idx")]
 
     def __str__(self):
         return self.text
+
+
+class HashtagUsage(Model):
+    """
+    Inverted hashtag index: how many times a user used a (lower-cased) tag,
+    leaving out the popular hashtags. Rebuilt from the Hashtag table, see
+    recommend.derived
+    """
+
+    tag = CharField()
+    user = ForeignKey(TweetUser, on_delete=CASCADE, related_name="hashtag_usage")
+    count = PositiveIntegerField(default=0)
+
+    class Meta:
+        # tag first, so the postings of a tag are a range of the unique index
+        unique_together = ("tag", "user")
+
+    def __str__(self):
+        return self.tag
+
+
+class UserInteraction(Model):
+    """
+    Derived table holding the reply and retweet counts between two users, in
+    both directions, for tweets in the valid languages. It is rebuilt from the
+    Tweet table (see recommend.derived) so the ranking doesn't have to
+    aggregate the whole table on every request
+    """
+
+    user_a = ForeignKey(TweetUser, on_delete=CASCADE, related_name="interactions")
+    user_b = ForeignKey(TweetUser, on_delete=CASCADE, related_name="+")
+    reply_count = PositiveIntegerField(default=0)
+    retweet_count = PositiveIntegerField(default=0)
+
+    class Meta:
+        # the unique index also serves the lookup by user_a
+        unique_together = ("user_a", "user_b")
+
+    def __str__(self):
+        return f"{self.user_a_id} <-> {self.user_b_id}"
+
+
+class DatasetVersion(Model):
+    """
+    Single row counter bumped by the management commands whenever the data
+    changes, cached recommendations are keyed by it so they never go stale
+    """
+
+    version = PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return str(self.version)
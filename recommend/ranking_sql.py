@@ -0,0 +1,160 @@
+"""
+Ranking computed in a single PostgreSQL query. It gives the same scores and
+order as RankingScore.calculate_final_scores, which stays the reference, but
+only the rows that can make the ranking ever leave the database.
+
+The scores are rounded to 5 decimals before they are ordered, and PostgreSQL
+can't round a float8 like round() does (the cast to numeric keeps 15 digits,
+so a score next to a half can round the other way). The query only cuts the
+candidates around the limit on the raw scores, the rounding, ordering and
+final cut are done in Python.
+"""
+
+import heapq
+
+from django.db import connection
+
+from .models import Hashtag, HashtagUsage, Tweet, UserInteraction, valid_languages
+
+# the contact tweets of each query type, same filters as
+# RankingScore.contact_tweets_queryset
+CONTACT_FILTERS = {
+    "reply": (
+        "(t.reply_to_user_id = %(user_id)s OR t.user_id = %(user_id)s) "
+        "AND t.reply_to_user_id IS NOT NULL"
+    ),
+    "retweet": (
+        "(r.user_id = %(user_id)s OR t.user_id = %(user_id)s) "
+        "AND t.retweet_id IS NOT NULL"
+    ),
+    "both": (
+        "((t.reply_to_user_id = %(user_id)s OR t.user_id = %(user_id)s) "
+        "AND t.reply_to_user_id IS NOT NULL) "
+        "OR ((r.user_id = %(user_id)s OR t.user_id = %(user_id)s) "
+        "AND t.retweet_id IS NOT NULL)"
+    ),
+}
+
+# the keyword score comes from the last contact tweet of every user, and the
+# phrase is counted like str.count does: non-overlapping, and an empty phrase
+# matches between every character
+RANKING_SQL = """
+WITH interaction_scores AS (
+    SELECT user_b_id AS user_id,
+           ln((1 + 2 * reply_count + retweet_count)::float8) AS score
+    FROM {interaction}
+    WHERE user_a_id = %(user_id)s
+),
+user_tags AS (
+    SELECT tag, count FROM {usage} WHERE user_id = %(user_id)s
+),
+tag_pairs AS (
+    SELECT p.user_id,
+           CASE WHEN p.user_id <> %(user_id)s THEN u.count + p.count ELSE 1 END
+               AS same_tag_count
+    FROM user_tags u
+    JOIN {usage} p ON p.tag = u.tag
+),
+hashtag_scores AS (
+    SELECT user_id,
+           SUM(CASE WHEN same_tag_count > 10
+                    THEN 1 + ln((1 + same_tag_count - 10)::float8)
+                    ELSE 1 END) AS score
+    FROM tag_pairs
+    GROUP BY user_id
+),
+contact_tweets AS (
+    SELECT DISTINCT ON (t.user_id)
+           t.user_id,
+           t.text,
+           (SELECT COUNT(*) FROM {hashtag} h
+            WHERE h.tweet_id = t.id
+              AND strpos(UPPER(h.text), UPPER(%(phrase)s)) > 0) AS hashtag_matches
+    FROM {tweet} t
+    LEFT JOIN {tweet} r ON r.id = t.retweet_id
+    WHERE ({contact_filter})
+      AND t.lang = ANY(%(languages)s)
+    ORDER BY t.user_id, t.id DESC
+),
+keyword_scores AS (
+    SELECT user_id,
+           1 + ln((
+               CASE WHEN %(phrase)s = '' THEN char_length(text) + 1
+                    ELSE (char_length(text)
+                          - char_length(replace(text, %(phrase)s, '')))
+                         / char_length(%(phrase)s)
+               END + hashtag_matches + 1
+           )::float8) AS score
+    FROM contact_tweets
+),
+final_scores AS (
+    SELECT i.user_id, i.score * COALESCE(h.score, 1) * k.score AS score
+    FROM interaction_scores i
+    JOIN keyword_scores k ON k.user_id = i.user_id
+    LEFT JOIN hashtag_scores h ON h.user_id = i.user_id
+)
+"""
+
+# the ranking of the final_scores defined before it
+RANKED_SQL = """
+SELECT user_id, score
+FROM final_scores
+WHERE score > 0
+"""
+
+# rounding can't move a score by more than half of the last decimal, so every
+# user ranked up to the limit scores at most one decimal above the raw
+# limit-th score. The margin leaves room for the float error
+CUTOFF_SQL = """
+  AND score <= COALESCE(
+      (SELECT score FROM final_scores WHERE score > 0
+       ORDER BY score LIMIT 1 OFFSET %(cutoff)s),
+      'infinity'
+  ) + %(margin)s
+"""
+CUTOFF_MARGIN = 2e-5
+
+
+def rank_users(user_id, query_type, phrase, limit=None):
+    """
+    The [(user_id, score)] ranking of the users recommended to user_id, in the
+    order of RankingScore.calculate_final_scores. Only the first limit rows
+    when given
+    """
+    if query_type not in CONTACT_FILTERS:
+        raise ValueError("Invalid query_type. Must be 'reply', 'retweet', or 'both'.")
+
+    sql = RANKING_SQL.format(
+        interaction=UserInteraction._meta.db_table,
+        usage=HashtagUsage._meta.db_table,
+        hashtag=Hashtag._meta.db_table,
+        tweet=Tweet._meta.db_table,
+        contact_filter=CONTACT_FILTERS[query_type],
+    )
+    params = {"user_id": user_id, "phrase": phrase, "languages": valid_languages}
+    return select_ranking(sql, params, limit)
+
+
+def select_ranking(scores_sql, params, limit=None):
+    """
+    The ranking of the final_scores common table expression that scores_sql
+    ends with
+    """
+    if limit == 0:
+        return []
+
+    sql = scores_sql + RANKED_SQL
+    if limit is not None:
+        sql += CUTOFF_SQL
+        params = {**params, "cutoff": limit - 1, "margin": CUTOFF_MARGIN}
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    # same rounding and order as RankingScore.combine_scores_python: score
+    # then user id, ascending
+    ranking = [(user_id, round(score, 5)) for user_id, score in rows]
+    if limit is not None and limit < len(ranking):
+        return heapq.nsmallest(limit, ranking, key=lambda item: (item[1], item[0]))
+    return sorted(ranking, key=lambda item: (item[1], item[0]))
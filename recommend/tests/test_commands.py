@@ -0,0 +1,203 @@
+import io
+import json
+import tempfile
+from pathlib import Path
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from ..management.commands import serve
+from ..models import Tweet, Hashtag, TweetUser, UserInteraction
+from ..views import RankingScore
+
+USERS = [
+    {
+        "id": 1,
+        "screen_name": "user1",
+        "description": "old",
+        "lang": "en",
+        "created_at": "Mon Jan 06 10:00:00 +0000 2014",
+        "updated_at": "Mon Jan 06 10:00:00 +0000 2014",
+    },
+    {
+        "id": 2,
+        "screen_name": "user2",
+        "description": None,
+        "lang": "en",
+        "created_at": "Mon Jan 06 10:00:00 +0000 2014",
+        "updated_at": "Tue Jan 07 10:00:00 +0000 2014",
+    },
+    {
+        "id": 1,
+        "screen_name": "user1",
+        "description": 'new \\ "quoted"',
+        "lang": "en",
+        "created_at": "Mon Jan 06 10:00:00 +0000 2014",
+        "updated_at": "Wed Jan 08 10:00:00 +0000 2014",
+    },
+]
+
+TWEETS = [
+    {
+        "id": 10,
+        "user": 2,
+        "text": "Hello\nworld",
+        "reply_to_user": None,
+        "lang": "en",
+        "created_at": "Wed Jan 08 10:00:00 +0000 2014",
+    },
+    {
+        "id": 11,
+        "user": 1,
+        "text": "RT Hello",
+        "reply_to_user": 2,
+        "retweet": 10,
+        "lang": "en",
+        "created_at": "Wed Jan 08 11:00:00 +0000 2014",
+    },
+    {
+        "id": 12,
+        "user": 1,
+        "text": "unknown retweet and reply",
+        "reply_to_user": 99,
+        "retweet": 999,
+        "lang": "es",
+        "created_at": "Wed Jan 08 12:00:00 +0000 2014",
+    },
+    {
+        "id": 13,
+        "user": 99,
+        "text": "unknown user",
+        "reply_to_user": None,
+        "lang": "en",
+        "created_at": "Wed Jan 08 12:00:00 +0000 2014",
+    },
+]
+
+HASHTAGS = [
+    {"user": 2, "tweet": 10, "text": "Hello"},
+    {"user": 2, "tweet": 10, "text": "World"},
+    {"user": 1, "tweet": 11, "text": "Hello"},
+    {"user": 1, "tweet": 11, "text": "Hello"},
+    {"user": 1, "tweet": 13, "text": "missing"},
+]
+
+
+class LoadCommandsTestCase(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.base_dir = Path(self.tmp_dir.name)
+        (self.base_dir / "filtered").mkdir()
+        for name, records in [
+            ("valid_usr_obj.txt", USERS),
+            ("valid_tweet_objects.txt", TWEETS),
+            ("valid_hashtags.txt", HASHTAGS),
+        ]:
+            with open(self.base_dir / "filtered" / name, "w") as file:
+                file.writelines(json.dumps(record) + "\n" for record in records)
+
+    def snapshot(self):
+        return (
+            list(TweetUser.objects.order_by("id").values()),
+            list(Tweet.objects.order_by("id").values()),
+            list(
+                Hashtag.objects.order_by("tweet_id", "text").values_list(
+                    "user_id", "tweet_id", "text", "is_popular"
+                )
+            ),
+            list(
+                UserInteraction.objects.order_by("user_a_id", "user_b_id").values_list(
+                    "user_a_id", "user_b_id", "reply_count", "retweet_count"
+                )
+            ),
+        )
+
+    def test_populate_commands(self):
+        with override_settings(BASE_DIR=self.base_dir):
+            call_command("populate_users", batch_size=2)
+            call_command("populate_tweets", batch_size=2)
+            call_command("populate_hashtags", batch_size=2)
+
+        users, tweets, hashtags, interactions = self.snapshot()
+        self.assertEqual(
+            [user["description"] for user in users], ['new \\ "quoted"', None]
+        )
+        self.assertEqual(
+            [(t["id"], t["reply_to_user_id"], t["retweet_id"]) for t in tweets],
+            [(10, None, None), (11, 2, 10), (12, None, None)],
+        )
+        self.assertEqual(len(hashtags), 3)
+        self.assertEqual(interactions, [(1, 2, 1, 1), (2, 1, 1, 1)])
+
+    def test_load_dataset_matches_populate_commands(self):
+        with override_settings(BASE_DIR=self.base_dir):
+            call_command("populate_users")
+            call_command("populate_tweets")
+            call_command("populate_hashtags")
+            expected = self.snapshot()
+
+            Tweet.objects.all().delete()
+            TweetUser.objects.all().delete()
+            call_command("load_dataset")
+            # twice, to go through the conflict updates
+            call_command("load_dataset")
+
+        self.assertEqual(self.snapshot(), expected)
+
+    def test_explain_scoring(self):
+        with override_settings(BASE_DIR=self.base_dir):
+            call_command("load_dataset")
+
+        # the tables are far too small for the planner to prefer the indexes,
+        # so this only checks every scoring query can be served by one
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+        out = io.StringIO()
+        call_command("explain_scoring", user_id=1, strict=True, stdout=out)
+
+        for name in ["interactions", "hashtag postings", "latest contact tweets"]:
+            self.assertIn(f"-- {name}", out.getvalue())
+
+    def test_precompute_recommendations(self):
+        with override_settings(BASE_DIR=self.base_dir):
+            call_command("load_dataset")
+
+        output = self.base_dir / "precomputed" / "both.jsonl"
+        call_command(
+            "precompute_recommendations",
+            str(output),
+            phrase="Hello",
+            processes=1,
+            chunk_size=1,
+        )
+
+        with open(output) as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual([record["user_id"] for record in records], [1, 2])
+        for record in records:
+            expected = RankingScore(
+                record["user_id"], "both", "Hello", None
+            ).calculate_final_scores()
+            self.assertEqual(record["recommendations"], [list(s) for s in expected])
+        self.assertTrue(any(record["recommendations"] for record in records))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+class ServeCommandTestCase(SimpleTestCase):
+    def test_gunicorn_options(self):
+        command = serve.Command()
+        parser = command.create_parser("manage.py", "serve")
+        kwargs = vars(parser.parse_args(["--workers", "3", "--threads", "4"]))
+
+        # every option is one gunicorn knows
+        config = serve.Application(None, command.gunicorn_options(kwargs)).cfg
+        self.assertEqual(config.workers, 3)
+        self.assertEqual(config.threads, 4)
+        self.assertEqual(config.max_requests, 1000)
+        self.assertTrue(config.preload_app)
+        self.assertIs(config.post_fork, serve.warm_up_worker)
+
+        kwargs = vars(parser.parse_args(["--asgi"]))
+        config = serve.Application(None, command.gunicorn_options(kwargs)).cfg
+        self.assertEqual(config.worker_class_str, serve.ASGI_WORKER)
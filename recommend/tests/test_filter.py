@@ -0,0 +1,185 @@
+import json
+import random
+import tempfile
+from itertools import pairwise
+from pathlib import Path
+
+from django.test import SimpleTestCase
+
+from malformed_duplicate_filter import (
+    get_user_objs,
+    merge_user_objs,
+    process_file,
+    process_lines,
+    read_range,
+    split_ranges,
+)
+from ..timestamps import parse_twitter_datetime
+
+USER_FIELDS = ("id", "screen_name", "description", "lang", "created_at")
+
+
+def raw_tweet(tweet_id, user_id, created_at, hashtags=("tag",), retweet=None):
+    tweet = {
+        "id": tweet_id,
+        "id_str": str(tweet_id),
+        "text": f"tweet {tweet_id} café ☕",
+        "lang": "en",
+        "created_at": created_at,
+        "in_reply_to_user_id": None,
+        "user": {
+            "id": user_id,
+            "id_str": str(user_id),
+            "screen_name": f"user{user_id}",
+            "description": f"profile of {user_id} at {created_at}",
+            "lang": "en",
+            "created_at": "Mon Jan 06 23:59:59 +0000 2014",
+        },
+        "entities": {"hashtags": [{"text": text} for text in hashtags]},
+    }
+    if retweet is not None:
+        tweet["retweeted_status"] = retweet
+    return tweet
+
+
+def generate_dump(path, tweets=60, seed=7):
+    """
+    a small raw dump with the cases the filter has to handle: duplicate tweets
+    far apart in the file, retweets, and malformed lines
+    """
+    rng = random.Random(seed)
+    lines = []
+    for tweet_id in range(1, tweets + 1):
+        created_at = (
+            f"Wed Oct 10 20:{tweet_id // 60:02d}:{tweet_id % 60:02d} +0000 2018"
+        )
+        retweet = None
+        if tweet_id % 4 == 0:
+            retweet = raw_tweet(
+                rng.randint(1, tweet_id), rng.randint(1, 8), created_at, ("rt",)
+            )
+        lines.append(
+            json.dumps(
+                raw_tweet(tweet_id, rng.randint(1, 8), created_at, retweet=retweet)
+            )
+        )
+    for _ in range(tweets // 5):
+        lines.insert(rng.randrange(len(lines)), rng.choice(lines))
+    lines.insert(3, "{not json")
+    lines.insert(10, json.dumps(raw_tweet(999, 1, "x", hashtags=())))
+    lines.insert(20, json.dumps({**raw_tweet(998, 1, "x"), "text": ""}))
+    lines.insert(30, "")
+    Path(path).write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+
+def old_user_objs(objs):
+    """
+    the user consolidation before the map/reduce: first seen position, replaced
+    in place by a strictly newer profile
+    """
+    valid_users = []
+    for twt in objs:
+        profiles = []
+        if twt.get("retweeted_status") is not None:
+            profiles.append(
+                {
+                    **{
+                        field: twt["retweeted_status"]["user"].get(field)
+                        for field in USER_FIELDS
+                    },
+                    "updated_at": twt["retweeted_status"]["created_at"],
+                }
+            )
+        profiles.append(
+            {
+                **{field: twt["user"][field] for field in USER_FIELDS},
+                "updated_at": twt["created_at"],
+            }
+        )
+        for profile in profiles:
+            existing = [user for user in valid_users if user["id"] == profile["id"]]
+            if not existing:
+                valid_users.append(profile)
+            elif parse_twitter_datetime(profile["updated_at"]) > parse_twitter_datetime(
+                existing[0]["updated_at"]
+            ):
+                existing[0].update(profile)
+    return valid_users
+
+
+class SplitRangesUnitTest(SimpleTestCase):
+    def assertSplitOnLines(self, content, parts):
+        with tempfile.TemporaryDirectory() as path:
+            input_file = Path(path, "input.txt")
+            input_file.write_bytes(content)
+            ranges = split_ranges(input_file, parts)
+
+            self.assertLessEqual(len(ranges), parts)
+            # the ranges cover the whole file, in order and without overlaps
+            self.assertEqual([start for start, _ in ranges[:1]], [0] if content else [])
+            for (_, end), (start, _) in pairwise(ranges):
+                self.assertEqual(end, start)
+                self.assertEqual(content[start - 1 : start], b"\n")
+            if ranges:
+                self.assertEqual(ranges[-1][1], len(content))
+
+            lines = [
+                line
+                for start, end in ranges
+                for line in read_range(input_file, start, end)
+            ]
+            self.assertEqual(lines, content.splitlines(keepends=True))
+
+    def test_boundaries_on_newlines(self):
+        content = b"".join(b"x" * (i % 7) + b"\n" for i in range(50))
+        for parts in (1, 2, 3, 8, 16):
+            self.assertSplitOnLines(content, parts)
+
+    def test_no_trailing_newline(self):
+        for parts in (1, 2, 5):
+            self.assertSplitOnLines(b"first\nsecond\nlast", parts)
+
+    def test_more_parts_than_lines(self):
+        self.assertSplitOnLines(b"a\nbb\nccc\n", 32)
+        self.assertSplitOnLines(b"one line", 4)
+        self.assertSplitOnLines(b"", 4)
+
+
+class FilterUnitTest(SimpleTestCase):
+    def filter(self, input_file, directory, split):
+        outputs = [
+            Path(directory, f"{split}.{name}")
+            for name in ("tweets", "users", "hashtags")
+        ]
+        process_file(input_file, *outputs, num_processes=2, chunk_lines=4, split=split)
+        return [output.read_bytes() for output in outputs]
+
+    def test_byte_split_same_as_line_split(self):
+        with tempfile.TemporaryDirectory() as path:
+            input_file = Path(path, "dump.txt")
+            generate_dump(input_file)
+
+            by_bytes = self.filter(input_file, path, "bytes")
+            by_lines = self.filter(input_file, path, "lines")
+
+            self.assertEqual(by_bytes, by_lines)
+            tweets = [json.loads(line) for line in by_bytes[0].splitlines()]
+            ids = [tweet["id"] for tweet in tweets]
+            self.assertEqual(len(ids), len(set(ids)))
+            self.assertNotIn(999, ids)
+            self.assertNotIn(998, ids)
+
+    def test_user_reduce_same_as_before(self):
+        with tempfile.TemporaryDirectory() as path:
+            input_file = Path(path, "dump.txt")
+            generate_dump(input_file)
+            with open(input_file, encoding="utf-8") as file:
+                objs = process_lines(file)
+
+        valid_users = {}
+        for start in range(0, len(objs), 4):
+            merge_user_objs(valid_users, get_user_objs(objs[start : start + 4]))
+
+        self.assertEqual(
+            [user for _, user in valid_users.values()], old_user_objs(objs)
+        )
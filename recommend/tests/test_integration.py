@@ -1,10 +1,16 @@
+import json
 from datetime import UTC, datetime
-from django.urls import reverse
-from rest_framework.test import APIClient, APITestCase
+from django.core.exceptions import ImproperlyConfigured
+from django.test import override_settings
+from django.urls import resolve, reverse
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
+from ..cache import bump_dataset_version, recommendation_cache
+from ..derived import rebuild_hashtag_usage, rebuild_user_interactions
 from ..models import Tweet, Hashtag, TweetUser
+from ..views import SQLRankingScore, get_ranking_engine, hydrate_recommendations
 
 
-class RecommendUsersIntegrationTestCase(APITestCase):
+class RecommendUsersDataMixin:
     def setUp(self):
         # Create test users
         self.user_1 = TweetUser.objects.create(
@@ -80,8 +86,20 @@ class RecommendUsersIntegrationTestCase(APITestCase):
             tweet=self.tweet_2, user=self.user_3, text="cloud", is_popular=False
         )
 
+        # derived tables read by the ranking
+        rebuild_user_interactions()
+        rebuild_hashtag_usage()
+
+        recommendation_cache.clear()
         self.client = APIClient()
 
+    def tearDown(self):
+        Tweet.objects.all().delete()
+        Hashtag.objects.all().delete()
+        TweetUser.objects.all().delete()
+
+
+class RecommendUsersIntegrationTestCase(RecommendUsersDataMixin, APITestCase):
     def test_recommend_users(self):
         url = reverse("recommend_users")
         response = self.client.get(
@@ -98,7 +116,202 @@ class RecommendUsersIntegrationTestCase(APITestCase):
 
         self.assertEqual(response.status_code, 200)
 
-    def tearDown(self):
-        Tweet.objects.all().delete()
-        Hashtag.objects.all().delete()
-        TweetUser.objects.all().delete()
+    def test_recommend_users_cached(self):
+        url = reverse("recommend_users")
+        params = {"user_id": self.user_2.id, "type": "both", "phrase": "Hello"}
+
+        first = self.client.get(url, params)
+        second = self.client.get(url, params)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(recommendation_cache.stats()["local_hits"], 1)
+
+        # a new dataset version is never served the old entries
+        bump_dataset_version()
+        self.client.get(url, params)
+        stats = self.client.get(reverse("recommendation_cache_stats")).json()
+        self.assertEqual(stats["local_hits"], 1)
+        self.assertEqual(stats["version"], 1)
+
+    def test_recommend_users_pages(self):
+        url = reverse("recommend_users")
+        params = {"user_id": self.user_2.id, "type": "both", "phrase": "Hello"}
+
+        everything = json.loads(self.client.get(url, params).content)
+        pages = [
+            json.loads(self.client.get(url, {**params, **page}).content)
+            for page in [{"limit": 1}, {"offset": 1, "limit": 10}, {"offset": 11}]
+        ]
+        self.assertTrue(everything)
+        self.assertEqual("\n".join(filter(None, pages)), everything)
+
+        response = self.client.get(url, {**params, "limit": "-1"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "limit must not be negative"})
+
+    def test_recommend_users_batch(self):
+        user_ids = [self.user_1.id, self.user_2.id, self.user_3.id]
+        response = self.client.post(
+            reverse("recommend_users_batch"),
+            {"user_ids": user_ids, "type": "both", "phrase": "Hello"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+
+        for user_id in user_ids:
+            expected = self.client.get(
+                reverse("recommend_users"),
+                {"user_id": user_id, "type": "both", "phrase": "Hello"},
+            )
+            self.assertEqual(
+                response.json()[str(user_id)], json.loads(expected.content)
+            )
+
+        for body in [
+            {"user_ids": ["x"]},
+            [user_ids],
+            {"user_ids": [True]},
+            {"user_ids": [1.7]},
+            {"user_ids": user_ids, "phrase": 5},
+            {"user_ids": user_ids, "hashtag": ["a"]},
+            {"user_ids": user_ids, "limit": [1]},
+            {"user_ids": user_ids, "limit": 1.7},
+            {"user_ids": user_ids, "offset": "1"},
+            {"user_ids": user_ids, "offset": -1},
+        ]:
+            response = self.client.post(
+                reverse("recommend_users_batch"), body, format="json"
+            )
+            self.assertEqual(response.status_code, 400, body)
+
+    def test_recommend_users_sql_engine(self):
+        url = reverse("recommend_users")
+        params = {"user_id": self.user_2.id, "type": "both", "phrase": "Hello"}
+
+        expected = self.client.get(url, params)
+        recommendation_cache.clear()
+        response = self.client.get(url, {**params, "engine": "sql"})
+        self.assertEqual(response.content, expected.content)
+
+    def test_recommend_users_unknown_engine(self):
+        params = {"user_id": self.user_2.id, "type": "both", "engine": "bogus"}
+        for name in ("recommend_users", "recommend_users_async"):
+            response = self.client.get(reverse(name), params)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(
+                response.json(), {"error": "engine must be one of 'python', 'sql'"}
+            )
+
+        with override_settings(RECOMMEND_ENGINE="sq"):
+            with self.assertRaises(ImproperlyConfigured):
+                get_ranking_engine()
+        self.assertIs(get_ranking_engine("sql"), SQLRankingScore)
+
+    @override_settings(RECOMMEND_TIMING_SAMPLE_RATE=1.0)
+    def test_recommend_users_timings(self):
+        url = reverse("recommend_users")
+        params = {"user_id": self.user_2.id, "type": "both", "phrase": "Hello"}
+
+        with self.assertLogs("recommend.timing") as logs:
+            response = self.client.get(url, params)
+
+        stages = ("interactions", "hashtags", "keywords", "hydrate")
+        for metric in (*stages, "db", "total"):
+            self.assertIn(f"{metric};dur=", response["Server-Timing"])
+        timings = json.loads(logs.records[0].getMessage())
+        self.assertEqual(timings["status"], 200)
+        self.assertEqual(timings["stages"]["interactions"]["queries"], 1)
+        self.assertEqual(timings["stages"]["keywords"]["queries"], 1)
+        self.assertEqual(timings["stages"]["combine"]["queries"], 0)
+        self.assertGreaterEqual(
+            timings["queries"],
+            sum(stage["queries"] for stage in timings["stages"].values()),
+        )
+
+        # a cached response has no stages
+        with self.assertLogs("recommend.timing") as logs:
+            response = self.client.get(url, params)
+        self.assertEqual(json.loads(logs.records[0].getMessage())["stages"], {})
+
+    def test_recommend_users_not_sampled(self):
+        url = reverse("recommend_users")
+        params = {"user_id": self.user_2.id, "type": "both", "phrase": "Hello"}
+
+        response = self.client.get(url, params)
+        self.assertNotIn("Server-Timing", response)
+
+    def test_metrics(self):
+        url = reverse("recommend_users")
+        self.client.get(url, {"user_id": self.user_2.id, "type": "both"})
+
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        metrics = response.content.decode()
+        for sample in (
+            'recommend_request_seconds_count{view="recommend_users"}',
+            'recommend_stage_seconds_count{stage="keywords"}',
+            'recommend_rows_fetched_total{stage="interactions"}',
+            'recommend_cache_lookups_total{result="miss"}',
+            "recommend_candidates_scored_total",
+        ):
+            self.assertIn(sample, metrics)
+
+    def test_read_views_not_atomic(self):
+        # ATOMIC_REQUESTS is on for the rest of the site
+        for name in ("recommend_users", "recommend_users_batch"):
+            view = resolve(reverse(name)).func
+            self.assertIn("default", getattr(view, "_non_atomic_requests", set()))
+
+    def test_hydrate_recommendations(self):
+        final_scores = [(3000, 1.5), (5000, 1.0), (9999, 0.5)]
+        with self.assertNumQueries(2):
+            response_data = hydrate_recommendations(self.user_2.id, final_scores)
+
+        # unknown users are dropped, users without a contact tweet are kept
+        self.assertEqual([data["user_id"] for data in response_data], [3000, 5000])
+        self.assertTrue(response_data[0]["contact_tweet_text"])
+        self.assertEqual(response_data[1]["contact_tweet_text"], "")
+
+
+# the async stages read through connections of their own, which only see
+# committed data
+class RecommendUsersAsyncTestCase(RecommendUsersDataMixin, APITransactionTestCase):
+    def test_matches_sync_view(self):
+        for params in [
+            {"user_id": self.user_1.id, "type": "both", "phrase": "Hello"},
+            {"user_id": self.user_2.id, "type": "reply", "phrase": "Hello"},
+            {"user_id": self.user_2.id, "type": "retweet", "phrase": "world"},
+        ]:
+            recommendation_cache.clear()
+            expected = self.client.get(reverse("recommend_users"), params)
+            recommendation_cache.clear()
+            response = self.client.get(reverse("recommend_users_async"), params)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["Content-Type"], "text/plain")
+            self.assertEqual(response.content, expected.content)
+
+    @override_settings(RECOMMEND_TIMING_SAMPLE_RATE=1.0)
+    def test_timings(self):
+        params = {"user_id": self.user_2.id, "type": "both", "phrase": "Hello"}
+        recommendation_cache.clear()
+        with self.assertLogs("recommend.timing") as logs:
+            response = self.client.get(reverse("recommend_users_async"), params)
+
+        for metric in ("interactions", "hashtags", "keywords", "combine", "hydrate"):
+            self.assertIn(f"{metric};dur=", response["Server-Timing"])
+        # the concurrent stages each count the queries of their own thread
+        stages = json.loads(logs.records[0].getMessage())["stages"]
+        self.assertEqual(stages["interactions"]["queries"], 1)
+        self.assertEqual(stages["keywords"]["queries"], 1)
+        self.assertEqual(stages["combine"]["queries"], 0)
+
+        metrics = self.client.get(reverse("metrics")).content.decode()
+        self.assertIn(
+            'recommend_request_seconds_count{view="recommend_users_async"}', metrics
+        )
+
+    def test_invalid_user_id(self):
+        response = self.client.get(reverse("recommend_users_async"), {"user_id": "x"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "user_id must be an integer"})
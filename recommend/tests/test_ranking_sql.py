@@ -0,0 +1,170 @@
+import random
+from datetime import UTC, datetime, timedelta
+from django.test import TestCase
+from ..derived import rebuild_hashtag_usage, rebuild_user_interactions
+from ..models import Tweet, Hashtag, TweetUser
+from ..ranking_sql import select_ranking
+from ..views import (
+    BatchRankingScore,
+    RankingScore,
+    SQLRankingScore,
+    hydrate_recommendations,
+    hydrate_recommendations_batch,
+    phrase_matches,
+)
+
+WORDS = ["hello", "Hello", "world", "lo", "l", "50%", "a_b", "ñandú", "hola"]
+TAGS = ["Hello", "hello", "HELLO", "world", "code", "lo", "a_b"]
+PHRASES = ["hello", "Hello", "lo", "l", "", "%", "_", "ñ", "missing"]
+
+
+class RankingDatasetMixin:
+    """
+    A seeded random dataset with enough replies, retweets and shared hashtags
+    to give non empty rankings to most users
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(7)
+        now = datetime.now(UTC)
+
+        users = TweetUser.objects.bulk_create(
+            TweetUser(
+                id=user_id,
+                screen_name=f"user{user_id}",
+                lang="en",
+                created_at=now,
+                updated_at=now,
+            )
+            for user_id in range(1, 13)
+        )
+        cls.user_ids = [user.id for user in users]
+
+        tweets = []
+        for tweet_id in range(1, 401):
+            tweet = Tweet(
+                id=tweet_id,
+                user_id=rng.choice(cls.user_ids),
+                text=" ".join(rng.choices(WORDS, k=rng.randint(1, 6))),
+                lang=rng.choice(["en", "es", "ja", "de"]),
+                # some tweets share a timestamp, the latest one is still by id
+                created_at=now - timedelta(minutes=rng.randint(0, 50)),
+            )
+            kind = rng.random()
+            if kind < 0.4:
+                tweet.reply_to_user_id = rng.choice(cls.user_ids)
+            elif kind < 0.7 and tweets:
+                tweet.retweet_id = rng.choice(tweets).id
+            tweets.append(tweet)
+        Tweet.objects.bulk_create(tweets)
+
+        hashtags = {}
+        for tweet in tweets:
+            for text in rng.sample(TAGS, rng.randint(0, 3)):
+                hashtags[(tweet.id, text)] = Hashtag(
+                    tweet_id=tweet.id,
+                    user_id=tweet.user_id,
+                    text=text,
+                    is_popular=rng.random() < 0.1,
+                )
+        Hashtag.objects.bulk_create(hashtags.values())
+
+        rebuild_user_interactions()
+        rebuild_hashtag_usage()
+
+
+class SQLRankingParityTest(RankingDatasetMixin, TestCase):
+    def test_same_ranking(self):
+        compared = 0
+        for user_id in self.user_ids:
+            for query_type in ["reply", "retweet", "both"]:
+                for phrase in PHRASES:
+                    args = (user_id, query_type, phrase, None)
+                    expected = RankingScore(*args).calculate_final_scores()
+                    with self.subTest(args=args):
+                        with self.assertNumQueries(1):
+                            ranking = SQLRankingScore(*args).calculate_final_scores()
+                        self.assertEqual(ranking, expected)
+                        self.assertEqual(
+                            SQLRankingScore(*args).calculate_final_scores(limit=3),
+                            expected[:3],
+                        )
+                    compared += bool(expected)
+
+        # the dataset has to give non empty rankings for this to mean anything
+        self.assertGreater(compared, 100)
+
+    def test_rounding_half(self):
+        # 1.234565 is stored a hair below the half, round() gives 1.23456 and
+        # round(score::numeric, 5) 1.23457
+        rng = random.Random(3)
+        scores = {1: 1.234565, 2: 1.234562, 3: 1.23457}
+        for user_id in range(6, 200):
+            scores[user_id] = round(rng.uniform(0, 2), 5) + rng.choice(
+                [5e-6, -5e-6, 4e-6, 0.0]
+            )
+        scores_sql = (
+            "WITH final_scores(user_id, score) AS "
+            "(SELECT * FROM unnest(%(user_ids)s::bigint[], %(scores)s::float8[]))"
+        )
+        params = {"user_ids": list(scores), "scores": list(scores.values())}
+
+        for limit in [None, 0, 1, 2, 3, 10, 100, 300]:
+            with self.subTest(limit=limit):
+                expected = RankingScore.combine_scores(
+                    scores, {}, dict.fromkeys(scores, 1.0), limit=limit
+                )
+                self.assertEqual(select_ranking(scores_sql, params, limit), expected)
+        ranking = select_ranking(scores_sql, params)
+        self.assertEqual(
+            [item for item in ranking if item[0] in (1, 2, 3)],
+            [(1, 1.23456), (2, 1.23456), (3, 1.23457)],
+        )
+
+    def test_invalid_query_type(self):
+        with self.assertRaises(ValueError):
+            SQLRankingScore(1, "quote", "hello", None).calculate_final_scores()
+
+
+class BatchRankingParityTest(RankingDatasetMixin, TestCase):
+    def test_same_ranking(self):
+        for query_type in ["reply", "retweet", "both"]:
+            for phrase in PHRASES:
+                # the queries are shared by all the users of the batch
+                with self.assertNumQueries(4):
+                    rankings = BatchRankingScore(
+                        self.user_ids, query_type, phrase, None
+                    ).calculate_final_scores()
+
+                for user_id in self.user_ids:
+                    args = (user_id, query_type, phrase, None)
+                    with self.subTest(args=args):
+                        self.assertEqual(
+                            rankings[user_id],
+                            RankingScore(*args).calculate_final_scores(),
+                        )
+
+    def test_same_hydration(self):
+        rankings = BatchRankingScore(
+            self.user_ids, "both", "hello", None
+        ).calculate_final_scores(limit=5)
+
+        with self.assertNumQueries(2):
+            response_data = hydrate_recommendations_batch(rankings)
+
+        for user_id, final_scores in rankings.items():
+            self.assertEqual(
+                response_data[user_id],
+                hydrate_recommendations(user_id, final_scores),
+            )
+
+
+class PhraseMatchesTest(RankingDatasetMixin, TestCase):
+    def test_same_as_str_count(self):
+        for phrase in PHRASES + ["hello hello", "lo l", "ll"]:
+            tweets = Tweet.objects.annotate(matches=phrase_matches(phrase)).values_list(
+                "text", "matches"
+            )
+            for text, matches in tweets:
+                self.assertEqual(matches, text.count(phrase), (text, phrase))
@@ -1,6 +1,26 @@
+import atexit
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
 from datetime import UTC, datetime
-from django.test import TestCase
-from ..models import Tweet, Hashtag, TweetUser
+from math import log
+from pathlib import Path
+from unittest.mock import patch
+from django.test import SimpleTestCase, TestCase, override_settings
+from ..cache import LRUCache, RecommendationCache
+from ..combine import combine_scores_vectorized
+from ..derived import rebuild_hashtag_usage, rebuild_user_interactions
+from ..graph import build_interaction_graph, get_interaction_graph, np
+from ..json_backend import dumps, loads, loads_tweet, orjson, project_tweet
+from ..metrics import ROWS_FETCHED, Registry, registry
+from ..models import Tweet, Hashtag, TweetUser, UserInteraction
+from ..timestamps import DATE_FORMAT, parse_twitter_datetime
 from ..views import RankingScore
 
 
@@ -88,6 +108,10 @@ class RankingScoreUnitTest(TestCase):
             tweet=self.tweet_2, user=self.user_3, text="cloud", is_popular=False
         )
 
+        # derived tables read by the ranking
+        rebuild_user_interactions()
+        rebuild_hashtag_usage()
+
     def test_calculate_interaction_scores(self):
         scorer = RankingScore(
             user_id=3000,
@@ -100,6 +124,41 @@ class RankingScoreUnitTest(TestCase):
             interaction_scores, {4000: 1.3862943611198906, 3000: 1.0986122886681098}
         )
 
+    def test_rebuild_user_interactions_for_users(self):
+        expected = set(
+            UserInteraction.objects.values_list(
+                "user_a_id", "user_b_id", "reply_count", "retweet_count"
+            )
+        )
+        rebuild_user_interactions(user_ids=[4000])
+        refreshed = set(
+            UserInteraction.objects.values_list(
+                "user_a_id", "user_b_id", "reply_count", "retweet_count"
+            )
+        )
+        self.assertEqual(refreshed, expected)
+        self.assertIn((3000, 4000, 1, 1), refreshed)
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_interaction_graph_snapshot(self):
+        with tempfile.TemporaryDirectory() as path:
+            build_interaction_graph(version=3).save(path)
+
+            with override_settings(RECOMMEND_GRAPH_SNAPSHOT=path):
+                self.assertIsNone(get_interaction_graph(version=2))
+                graph = get_interaction_graph(version=3)
+
+            for user_id in [3000, 4000, 5000, 9999]:
+                expected = RankingScore(
+                    user_id, "both", "Hello", None
+                ).calculate_interaction_scores()
+                scorer = RankingScore(user_id, "both", "Hello", None, graph=graph)
+                key = ROWS_FETCHED.key({"stage": "interactions"})
+                before = registry.collect().get(key, 0)
+                with self.assertNumQueries(0):
+                    self.assertEqual(scorer.calculate_interaction_scores(), expected)
+                self.assertEqual(registry.collect()[key] - before, len(expected))
+
     def test_calculate_hashtag_scores(self):
         scorer = RankingScore(
             user_id=4000,
@@ -110,6 +169,23 @@ class RankingScoreUnitTest(TestCase):
         hashtag_scores = scorer.calculate_hashtag_scores()
         self.assertEqual(hashtag_scores, {4000: 1.0})
 
+    def test_calculate_hashtag_scores_other_users(self):
+        Hashtag.objects.create(
+            tweet=self.tweet_4, user=self.user_2, text="TEST", is_popular=False
+        )
+        rebuild_hashtag_usage()
+
+        scorer = RankingScore(
+            user_id=3000,
+            query_type="both",
+            phrase="Hello",
+            hashtag="test",
+        )
+        with self.assertNumQueries(2):
+            hashtag_scores = scorer.calculate_hashtag_scores()
+        # one point per tag for the user, "test" is shared with user 4000
+        self.assertEqual(hashtag_scores, {3000: 4.0, 4000: 1.0})
+
     def test_calculate_keywords_score(self):
         scorer = RankingScore(
             user_id=5000,
@@ -120,7 +196,332 @@ class RankingScoreUnitTest(TestCase):
         keyword_scores = scorer.calculate_keywords_score()
         self.assertEqual(keyword_scores, {})
 
+    def test_calculate_keywords_score_single_query(self):
+        scorer = RankingScore(
+            user_id=3000,
+            query_type="both",
+            phrase="Hello",
+            hashtag="test",
+        )
+        with self.assertNumQueries(1):
+            keyword_scores = scorer.calculate_keywords_score()
+        # "Hello Test" plus its "hello" hashtag for user 3000
+        self.assertEqual(keyword_scores, {3000: 1 + log(3), 4000: 1.0})
+
     def tearDown(self):
         Tweet.objects.all().delete()
         Hashtag.objects.all().delete()
         TweetUser.objects.all().delete()
+
+
+class CombineScoresUnitTest(SimpleTestCase):
+    def random_scores(self, rng, ids, low, high):
+        scores = {}
+        for user_id in rng.sample(ids, rng.randint(0, len(ids))):
+            # some exact values, so ties and rounding halves come up too
+            scores[user_id] = rng.choice(
+                [rng.uniform(low, high), round(rng.uniform(low, high), 6), low]
+            )
+        return scores
+
+    def test_top_k_same_as_sorted(self):
+        rng = random.Random(3)
+        ids = range(1, 200)
+        stages = (
+            {user_id: rng.choice([0.5, 1.0, rng.random()]) for user_id in ids},
+            {},
+            {user_id: 2.0 for user_id in ids},
+        )
+        ranking = RankingScore.combine_scores_python(*stages)
+        # plenty of ties, ordered by user id
+        self.assertEqual(ranking[:3], sorted(ranking, key=lambda s: (s[1], s[0]))[:3])
+        for limit in [0, 1, 10, 198, 199, 500]:
+            self.assertEqual(
+                RankingScore.combine_scores_python(*stages, limit=limit),
+                ranking[:limit],
+            )
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_same_as_python_loop(self):
+        rng = random.Random(42)
+        for _ in range(300):
+            ids = rng.sample(range(1, 2**62), rng.randint(0, 200))
+            ids += rng.sample(range(1, 50), 20)
+            stages = (
+                self.random_scores(rng, ids, 0, 5),
+                self.random_scores(rng, ids, 1, 4),
+                self.random_scores(rng, ids, 1, 3),
+            )
+            expected = RankingScore.combine_scores_python(*stages)
+            with self.subTest(stages=stages):
+                self.assertEqual(combine_scores_vectorized(*stages), expected)
+                for limit in [0, 1, rng.randint(0, 40), len(expected) + 1]:
+                    self.assertEqual(
+                        combine_scores_vectorized(*stages, limit=limit),
+                        expected[:limit],
+                    )
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_empty(self):
+        self.assertEqual(combine_scores_vectorized({}, {}, {}), [])
+
+
+class LRUCacheUnitTest(TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+
+class RecommendationCacheUnitTest(SimpleTestCase):
+    def test_set_interleaved_with_bump(self):
+        cache = RecommendationCache(max_entries=10)
+        check_version = cache._check_version
+
+        def bump_after_check(version):
+            current = check_version(version)
+            if version == 1:
+                # another thread sees the bump between the check and the store
+                cache._check_version = check_version
+                self.assertIsNone(cache.get("scores", "key", 2))
+            return current
+
+        cache.get("scores", "key", 1)
+        cache._check_version = bump_after_check
+        cache.set("scores", "key", 1, "old")
+
+        self.assertIsNone(cache.get("scores", "key", 2))
+        self.assertEqual(cache.version, 2)
+
+    def test_older_version_keeps_entries(self):
+        cache = RecommendationCache(max_entries=10)
+        cache.set("scores", "key", 2, "new")
+        # a slow request that read the version before the bump
+        self.assertIsNone(cache.get("scores", "other", 1))
+        cache.set("scores", "other", 1, "old")
+
+        self.assertEqual(cache.get("scores", "key", 2), "new")
+        self.assertIsNone(cache.get("scores", "other", 2))
+        self.assertEqual(cache.stats()["version"], 2)
+
+
+class MetricsRegistryUnitTest(SimpleTestCase):
+    def registry(self, path):
+        registry = Registry(path)
+        # the directory is gone by the time the tests exit
+        self.addCleanup(atexit.unregister, registry.flush)
+        return registry
+
+    def test_exposition(self):
+        registry = Registry()
+        rows = registry.counter("rows_total", "Rows.", ["stage"])
+        latency = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1))
+        rows.inc(3, stage="keywords")
+        rows.inc(2, stage="keywords")
+        latency.observe(0.05)
+        latency.observe(0.5)
+        latency.observe(5)
+
+        lines = registry.exposition().splitlines()
+        self.assertIn("# TYPE rows_total counter", lines)
+        self.assertIn('rows_total{stage="keywords"} 5', lines)
+        self.assertIn("# TYPE latency_seconds histogram", lines)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 2', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn("latency_seconds_sum 5.55", lines)
+        self.assertIn("latency_seconds_count 3", lines)
+
+    def test_sums_processes(self):
+        with tempfile.TemporaryDirectory() as path:
+            registry = self.registry(path)
+            rows = registry.counter("rows_total", "Rows.")
+            latency = registry.histogram("latency_seconds", "Latency.", buckets=(1,))
+            rows.inc(2)
+            latency.observe(0.5)
+
+            def work():
+                # starts from zero, what it inherited is the parent's
+                rows.inc(3)
+                latency.observe(2)
+                registry.flush()
+
+            child = multiprocessing.get_context("fork").Process(target=work)
+            child.start()
+            child.join()
+
+            lines = registry.exposition().splitlines()
+            self.assertIn("rows_total 5", lines)
+            self.assertIn('latency_seconds_bucket{le="1.0"} 1', lines)
+            self.assertIn('latency_seconds_bucket{le="+Inf"} 2', lines)
+            self.assertIn("latency_seconds_count 2", lines)
+
+    def test_totals_never_decrease(self):
+        with tempfile.TemporaryDirectory() as path:
+            registry = self.registry(path)
+            rows = registry.counter("rows_total", "Rows.")
+            # left by a process that had the pid of this one
+            Path(path, f"{os.getpid()}-0ld.json").write_text(
+                json.dumps([["rows_total", [], 7]])
+            )
+
+            def worker():
+                rows.inc(3)
+                registry.flush()
+
+            totals = []
+            for _ in range(3):
+                # a recycled worker, gone once it wrote its file
+                child = multiprocessing.get_context("fork").Process(target=worker)
+                child.start()
+                child.join()
+                rows.inc(1)
+                registry.flush()
+                totals.append(registry.collect()[("rows_total", ())])
+
+            self.assertEqual(totals, [11, 15, 19])
+            # the files of the workers that are gone are folded into one when
+            # the next one starts, only the last worker's is left
+            files = {p.name for p in Path(path).glob("*.json")}
+            self.assertEqual(len(files), 3)
+            self.assertTrue({"merged.json", registry.filename} <= files)
+
+    def test_concurrent_flushes(self):
+        with tempfile.TemporaryDirectory() as path:
+            registry = self.registry(path)
+            rows = registry.counter("rows_total", "Rows.")
+
+            def work():
+                for _ in range(200):
+                    rows.inc()
+                    registry.flush()
+
+            with (
+                patch("recommend.metrics.FLUSH_INTERVAL", 0),
+                self.assertNoLogs("recommend.metrics", level="WARNING"),
+            ):
+                threads = [threading.Thread(target=work) for _ in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+            self.assertEqual(registry.collect()[("rows_total", ())], 1600)
+            registry.flush()
+            written = json.loads(Path(path, registry.filename).read_text())
+            self.assertEqual(written, [["rows_total", [], 1600]])
+
+
+class JsonBackendUnitTest(SimpleTestCase):
+    def backend(self, **environ):
+        env = {
+            key: value
+            for key, value in os.environ.items()
+            if key != "RECOMMEND_JSON_BACKEND"
+        }
+        return subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "from recommend.json_backend import BACKEND; print(BACKEND)",
+            ],
+            env={**env, **environ},
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+
+    def test_backend_switch(self):
+        self.assertEqual(self.backend(), "json" if orjson is None else "orjson")
+        self.assertEqual(self.backend(RECOMMEND_JSON_BACKEND="json"), "json")
+
+    def test_same_as_json(self):
+        # orjson rejects the lone surrogate and NaN, json doesn't
+        for line in [
+            '{"text": "café ☕ \\u00e9"}',
+            '{"text": "\\ud83d"}',
+            "[NaN]",
+            "[1, 2.5]",
+        ]:
+            expected = json.loads(line)
+            self.assertEqual(repr(loads(line)), repr(expected))
+            self.assertEqual(repr(loads(line.encode("utf-8"))), repr(expected))
+
+        for obj in [{"text": "café ☕"}, {"text": "\ud83d"}, [1, 2.5]]:
+            self.assertEqual(loads(dumps(obj)), obj)
+
+        for line in ["{not json", '{"a": 1', ""]:
+            with self.assertRaises(ValueError):
+                loads(line)
+
+    def test_project_tweet(self):
+        user = {
+            "id": 1,
+            "id_str": "1",
+            "screen_name": "one",
+            "description": "",
+            "lang": "en",
+            "created_at": "Wed Oct 10 20:19:24 +0000 2018",
+            "followers_count": 10,
+        }
+        raw = {
+            "id": 2,
+            "id_str": "2",
+            "text": "hi #tag",
+            "lang": "en",
+            "created_at": "Wed Oct 10 20:19:24 +0000 2018",
+            "user": user,
+            "source": "web",
+            "entities": {"hashtags": [{"text": "tag", "indices": [3, 7]}], "urls": []},
+            "retweeted_status": {"id": 3, "user": user, "entities": {"hashtags": []}},
+        }
+
+        tweet = loads_tweet(dumps(raw))
+        self.assertEqual(tweet, project_tweet(raw))
+        self.assertNotIn("source", tweet)
+        self.assertNotIn("followers_count", tweet["user"])
+        self.assertEqual(tweet["user"]["screen_name"], "one")
+        self.assertEqual(tweet["entities"], {"hashtags": [{"text": "tag"}]})
+        self.assertIsNone(tweet["in_reply_to_user_id"])
+
+        retweet = tweet["retweeted_status"]
+        self.assertEqual(retweet["id"], 3)
+        self.assertEqual(retweet["entities"], {"hashtags": []})
+        self.assertIsNone(retweet["retweeted_status"])
+        self.assertIsNone(project_tweet({"id": 4})["user"])
+        # not a tweet, left to the validation of the filter
+        self.assertEqual(loads_tweet("[1]"), [1])
+
+
+class TimestampParserUnitTest(SimpleTestCase):
+    def test_matches_strptime(self):
+        for value in [
+            "Wed Oct 10 20:19:24 +0000 2018",
+            "Sun Feb 29 00:00:00 +0000 2004",
+            "Mon Jan 06 23:59:59 -0530 2014",
+            "Tue Dec 31 12:30:00 +1245 2013",
+        ]:
+            parsed = parse_twitter_datetime(value)
+            self.assertEqual(parsed, datetime.strptime(value, DATE_FORMAT))
+            self.assertEqual(
+                parsed.utcoffset(), datetime.strptime(value, DATE_FORMAT).utcoffset()
+            )
+
+    def test_invalid_values(self):
+        for value in [
+            "Wed Foo 10 20:19:24 +0000 2018",
+            "Xyz Oct 10 20:19:24 +0000 2018",
+            "Wed Oct +1 20:19:24 +0000 2018",
+            "Wed Oct 10 20:-1:24 +0000 2018",
+            "Wed Oct 10 20:19:24 +0000 +018",
+            "2018-10-10T20:19:24Z",
+            "",
+        ]:
+            with self.assertRaises(ValueError):
+                parse_twitter_datetime(value)
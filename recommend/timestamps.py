@@ -0,0 +1,82 @@
+"""
+Parser for the fixed timestamp format of the Twitter API, for example
+"Wed Oct 10 20:19:24 +0000 2018". It slices the fields out by position instead
+of going through strptime, and the results are memoized since many records
+share the same second. Anything not in that exact format goes to strptime.
+
+This module doesn't depend on Django so the filter script can use it too.
+"""
+
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+DATE_FORMAT = "%a %b %d %H:%M:%S %z %Y"
+
+WEEKDAYS = {"Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"}
+
+MONTHS = {
+    "Jan": 1,
+    "Feb": 2,
+    "Mar": 3,
+    "Apr": 4,
+    "May": 5,
+    "Jun": 6,
+    "Jul": 7,
+    "Aug": 8,
+    "Sep": 9,
+    "Oct": 10,
+    "Nov": 11,
+    "Dec": 12,
+}
+
+# "Wed Oct 10 20:19:24 +0000 2018"
+TIMESTAMP_LENGTH = 30
+SEPARATORS = ((3, " "), (7, " "), (10, " "), (13, ":"), (16, ":"), (19, " "), (25, " "))
+# day, hour, minute, second and year, int() alone would take " 1" or "+1"
+NUMBERS = (slice(8, 10), slice(11, 13), slice(14, 16), slice(17, 19), slice(26, 30))
+
+
+@lru_cache(maxsize=64)
+def _timezone(offset):
+    if offset == "+0000":
+        return timezone.utc
+    minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+    return timezone(timedelta(minutes=-minutes if offset[0] == "-" else minutes))
+
+
+def _parse(value):
+    if len(value) != TIMESTAMP_LENGTH or any(
+        value[index] != separator for index, separator in SEPARATORS
+    ):
+        raise ValueError(value)
+
+    if value[0:3] not in WEEKDAYS or not all(
+        value[number].isdigit() for number in NUMBERS
+    ):
+        raise ValueError(value)
+
+    offset = value[20:25]
+    if offset[0] not in "+-" or not offset[1:].isdigit():
+        raise ValueError(value)
+
+    return datetime(
+        int(value[26:30]),
+        MONTHS[value[4:7]],
+        int(value[8:10]),
+        int(value[11:13]),
+        int(value[14:16]),
+        int(value[17:19]),
+        tzinfo=_timezone(offset),
+    )
+
+
+@lru_cache(maxsize=1 << 16)
+def parse_twitter_datetime(value):
+    """
+    same result as datetime.strptime(value, DATE_FORMAT)
+    """
+    try:
+        return _parse(value)
+    except (KeyError, ValueError):
+        # not the usual layout, strptime raises the proper error if it's invalid
+        return datetime.strptime(value, DATE_FORMAT)
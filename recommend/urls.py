@@ -2,9 +2,19 @@ from django.urls import path, re_path, include
 from django.conf.urls.static import static
 
 
-from .views import recommend_users
+from .views import (
+    recommend_users,
+    recommend_users_async,
+    recommend_users_batch,
+    recommendation_cache_stats,
+    metrics,
+)
 
 
 urlpatterns = [
     path("q2", recommend_users, name="recommend_users"),
+    path("q2/async", recommend_users_async, name="recommend_users_async"),
+    path("q2/batch", recommend_users_batch, name="recommend_users_batch"),
+    path("q2/cache", recommendation_cache_stats, name="recommendation_cache_stats"),
+    path("metrics", metrics, name="metrics"),
 ]
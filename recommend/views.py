@@ -1,149 +1,142 @@
+import asyncio
+import heapq
 from math import log
 from collections import defaultdict
+from contextlib import nullcontext
 from urllib.parse import unquote
-from django.db.models import Q, Count
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, transaction
+from django.db.models import Q, Count, Value
+from django.db.models.functions import Length, Replace
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.http import require_GET
 from rest_framework.decorators import api_view
+from rest_framework.renderers import JSONRenderer
 from rest_framework.views import Response, status
 
-from .models import TweetUser, Tweet, Hashtag
-
-valid_languages = ["ar", "en", "fr", "in", "pt", "es", "tr", "ja"]
+from .cache import get_dataset_version, recommendation_cache
+from .combine import VECTORIZE_MIN_CANDIDATES, combine_scores_vectorized, np
+from .graph import get_interaction_graph
+from .instrumentation import instrumented, timed_stage
+from .metrics import CANDIDATES_SCORED, ROWS_FETCHED, registry
+from .ranking_sql import rank_users
+from .models import (
+    TweetUser,
+    Tweet,
+    HashtagUsage,
+    UserInteraction,
+    valid_languages,
+)
+
+
+def phrase_matches(phrase):
+    """
+    The number of times phrase is in the tweet text, counted by the database
+    the way str.count does it: case sensitive, non-overlapping, and an empty
+    phrase matches between every character. The texts never leave the database
+    """
+    if not phrase:
+        return Length("text") + 1
+    # replace() removes the occurrences left to right without overlaps, like
+    # str.count finds them
+    return (
+        Length("text") - Length(Replace("text", Value(phrase), Value("")))
+    ) / Length(Value(phrase))
 
 
 # Create your views here.
 class RankingScore:
-    def __init__(self, user_id, query_type, phrase, hashtag):
+    def __init__(self, user_id, query_type, phrase, hashtag, graph=None):
         self.user_id = user_id
         self.query_type = query_type
         self.phrase = phrase
         self.hashtag = hashtag
+        # an InteractionGraph snapshot to read the interactions from instead
+        # of the database, see recommend.graph
+        self.graph = graph
+
+    def interaction_queryset(self):
+        return UserInteraction.objects.filter(user_a_id=self.user_id).values(
+            "user_b_id", "reply_count", "retweet_count"
+        )
 
     def calculate_interaction_scores(self):
         """
         The interaction is defined as either a reply or retweet
-        between user a and other users. Using that, we are going to fetch data
-        and based on the availability, we'll get our result
+        between user a and other users. The counts in both directions are
+        kept in the UserInteraction table, so this is a single lookup on the
+        rows of the given user
         """
-        user_a_replied = (
-            Tweet.objects.filter(
-                user_id=self.user_id,
-                reply_to_user__isnull=False,
-                lang__in=valid_languages,
-            )
-            .exclude(reply_to_user_id=self.user_id)
-            .values("reply_to_user_id")
-            .annotate(reply_count=Count("id"))
-        )
-        user_b_replied = (
-            Tweet.objects.filter(
-                reply_to_user_id=self.user_id,
-                lang__in=valid_languages,
-            )
-            .exclude(user_id=self.user_id)
-            .values("user_id")
-            .annotate(reply_count=Count("id"))
-        )
-        user_a_retweeted = (
-            Tweet.objects.filter(
-                user_id=self.user_id,
-                retweet__isnull=False,
-                lang__in=valid_languages,
-            )
-            .values("retweet__user_id")
-            .annotate(retweet_count=Count("id"))
-        )
+        if self.graph is not None:
+            interaction_scores = self.graph.interaction_scores(self.user_id)
+        else:
+            interaction_scores = {
+                interaction["user_b_id"]: self.interaction_score(
+                    interaction["reply_count"], interaction["retweet_count"]
+                )
+                for interaction in self.interaction_queryset()
+            }
+        # one row per other user
+        ROWS_FETCHED.inc(len(interaction_scores), stage="interactions")
+        return interaction_scores
 
-        user_b_retweeted = (
-            Tweet.objects.filter(
-                retweet__user_id=self.user_id,
-                lang__in=valid_languages,
-            )
-            .values("user_id")
-            .annotate(retweet_count=Count("id"))
-        )
+    @staticmethod
+    def interaction_score(reply_count, retweet_count):
+        return log(1 + 2 * reply_count + retweet_count)
 
-        # using these two to ensure proper calculation at the end
-        reply_interaction_scores = defaultdict(int)
-        retweet_interaction_scores = defaultdict(int)
-
-        for reply in user_a_replied:
-            target_user_id = reply["reply_to_user_id"]
-            reply_count = reply["reply_count"]
-            reply_interaction_scores[target_user_id] += reply_count
-
-        for reply in user_b_replied:
-            source_user_id = reply["user_id"]
-            reply_count = reply["reply_count"]
-            if source_user_id in reply_interaction_scores:
-                reply_interaction_scores[source_user_id] += reply_count
-            else:
-                reply_interaction_scores[source_user_id] = reply_count
-
-        for retweet in user_a_retweeted:
-            target_user_id = retweet["retweet__user_id"]
-            retweet_count = retweet["retweet_count"]
-            if target_user_id in retweet_interaction_scores:
-                retweet_interaction_scores[target_user_id] += retweet_count
-            else:
-                retweet_interaction_scores[target_user_id] = retweet_count
-
-        for retweet in user_b_retweeted:
-            source_user_id = retweet["user_id"]
-            retweet_count = retweet["retweet_count"]
-            if source_user_id in retweet_interaction_scores:
-                retweet_interaction_scores[source_user_id] += retweet_count
-            else:
-                retweet_interaction_scores[source_user_id] = retweet_count
-
-        interaction_scores = {}
-        # since we have replies and retweets, we want to make sure all ids
-        # have the proper count values
-        all_users = set(reply_interaction_scores.keys()).union(
-            set(retweet_interaction_scores.keys())
+    def user_hashtags_queryset(self):
+        # ordered, so the hashtag scores are always summed in the same order
+        return (
+            HashtagUsage.objects.filter(user_id=self.user_id)
+            .order_by("tag")
+            .values_list("tag", "count")
         )
 
-        for user in all_users:
-            reply_count = reply_interaction_scores.get(user, 0)
-            retweet_count = retweet_interaction_scores.get(user, 0)
-            interaction_scores[user] = log(1 + 2 * reply_count + retweet_count)
-
-        return interaction_scores
+    def hashtag_postings_queryset(self, tags):
+        return (
+            HashtagUsage.objects.filter(tag__in=tags)
+            .order_by("tag", "user_id")
+            .values_list("tag", "user_id", "count")
+        )
 
-    def get_valid_user_hashtags(self, tag):
+    def get_valid_user_hashtags(self, tags):
         """
-        Checking for other users that may have use the same hashtag as the user
+        Checking for other users that may have use the same hashtags as the user,
+        all the tags are looked up at once in the hashtag index
         """
-        # prioritizing the tag before the user in search
-        hashtags = (
-            Hashtag.objects.filter(text__icontains=tag, is_popular=False)
-            .values("tweet__user_id")
-            .annotate(count=Count("text"))
-        )
-        # prioritizing the user in result and then the count of the tag
-        return {hashtag["tweet__user_id"]: hashtag["count"] for hashtag in hashtags}
+        postings = defaultdict(dict)
+        usages = list(self.hashtag_postings_queryset(tags))
+        for tag, user_id, count in usages:
+            postings[tag][user_id] = count
+        ROWS_FETCHED.inc(len(usages), stage="hashtags")
+        return postings
 
     def calculate_hashtag_scores(self):
         """
         Calculating th ehashtag scores user the user id given and hashtags used by the
         given user to find others
         """
-        hashtags = (
-            Hashtag.objects.filter(tweet__user_id=self.user_id, is_popular=False)
-            .values("text")
-            .annotate(count=Count("text"))
-        )
+        hashtags = dict(self.user_hashtags_queryset())
+        ROWS_FETCHED.inc(len(hashtags), stage="hashtags")
+        if not hashtags:
+            return defaultdict(float)
 
+        postings = self.get_valid_user_hashtags(hashtags)
+        return self.hashtag_scores_from(self.user_id, hashtags, postings)
+
+    @staticmethod
+    def hashtag_scores_from(user_id, hashtags, postings):
+        """
+        The hashtag scores of user_id from its {tag: count} and the postings
+        {tag: {user_id: count}} of those tags
+        """
         # using defaultdict to avoid key error
         hashtag_scores = defaultdict(float)
-        for hashtag in hashtags:
-            text = hashtag["text"].lower()
-            count = hashtag["count"]
-
-            valid_user_hashtags = self.get_valid_user_hashtags(text)
-            for other_user_id, other_count in valid_user_hashtags.items():
-                same_tag_count = (
-                    count + other_count if other_user_id != self.user_id else 1
-                )
+        for tag, count in hashtags.items():
+            for other_user_id, other_count in postings[tag].items():
+                same_tag_count = count + other_count if other_user_id != user_id else 1
                 if same_tag_count > 10:
                     hashtag_scores[other_user_id] += 1 + log(1 + same_tag_count - 10)
                 else:
@@ -151,11 +144,10 @@ class RankingScore:
 
         return hashtag_scores
 
-    def calculate_keywords_score(self):
+    def contact_tweets_queryset(self):
         """
-        Keyword scores between users that have contacted each other. The contact is defined as
-        either a reply or a retweet. we'll also use case insensitive for the hashtag and case sensitive
-        for the keywords
+        The contact tweets of the user with their number of hashtags matching the
+        phrase, the contact is defined as either a reply or a retweet
         """
         if self.query_type not in ["reply", "retweet", "both"]:
             raise ValueError(
@@ -183,44 +175,100 @@ class RankingScore:
             ),
         }[self.query_type]
 
-        tweets = Tweet.objects.filter(
-            tweet_filter,
-            lang__in=valid_languages,
-        ).values("user_id", "text", "id")
+        # the phrase and hashtag matches of every contact tweet are counted in
+        # the same query, ordered so the last tweet of a user still decides the
+        # score
+        return (
+            Tweet.objects.filter(
+                tweet_filter,
+                lang__in=valid_languages,
+            )
+            .annotate(
+                phrase_matches=phrase_matches(self.phrase),
+                hashtag_matches=Count(
+                    "hashtag", filter=Q(hashtag__text__icontains=self.phrase)
+                ),
+            )
+            .values("user_id", "phrase_matches", "hashtag_matches")
+            .order_by("id")
+        )
 
-        # keyword score is 0 if there are no contact tweets
-        if not tweets:
-            return {}
+    def calculate_keywords_score(self):
+        """
+        Keyword scores between users that have contacted each other. The contact is defined as
+        either a reply or a retweet. we'll also use case insensitive for the hashtag and case sensitive
+        for the keywords
+        """
+        tweets = list(self.contact_tweets_queryset())
 
         keyword_scores = {}
         for tweet in tweets:
-            user_id = tweet["user_id"]
-            content = tweet["text"]
-            number_of_matches = 0
+            keyword_scores[tweet["user_id"]] = self.keyword_score(tweet)
+        ROWS_FETCHED.inc(len(tweets), stage="keywords")
 
-            # Count phrase matches
-            number_of_matches += content.count(self.phrase)
+        # keyword score is 0 if there are no contact tweets
+        return keyword_scores
 
-            # Count hashtag matches
-            hashtags_in_tweet = Hashtag.objects.filter(
-                tweet_id=tweet["id"], text__icontains=self.phrase
-            ).count()
-            number_of_matches += hashtags_in_tweet
+    @staticmethod
+    def keyword_score(tweet):
+        # Count phrase and hashtag matches
+        number_of_matches = tweet["phrase_matches"]
+        number_of_matches += tweet["hashtag_matches"]
 
-            # keyword score is only 0 if there is no contact tweet
-            keyword_score = 1 + log(number_of_matches + 1)
-            keyword_scores[user_id] = keyword_score
+        # keyword score is only 0 if there is no contact tweet
+        return 1 + log(number_of_matches + 1)
 
-        return keyword_scores
+    def calculate_final_scores(self, limit=None):
+        """
+        Final calculation based on the given values from the other three, only
+        the first limit users of the ranking when given
+        """
+        with timed_stage("interactions"):
+            interaction_scores = self.calculate_interaction_scores()
+        with timed_stage("hashtags"):
+            hashtag_scores = self.calculate_hashtag_scores()
+        with timed_stage("keywords"):
+            keyword_scores = self.calculate_keywords_score()
+        with timed_stage("combine"):
+            return self.combine_scores(
+                interaction_scores, hashtag_scores, keyword_scores, limit=limit
+            )
 
-    def calculate_final_scores(self):
+    async def acalculate_final_scores(self, limit=None):
         """
-        Final calculation based on the given values from the other three
+        Same as calculate_final_scores, with the three stages running at the
+        same time, each in a worker thread with its own database connection
         """
-        interaction_scores = self.calculate_interaction_scores()
-        hashtag_scores = self.calculate_hashtag_scores()
-        keyword_scores = self.calculate_keywords_score()
+        interaction_scores, hashtag_scores, keyword_scores = await asyncio.gather(
+            run_stage(self.calculate_interaction_scores, "interactions"),
+            run_stage(self.calculate_hashtag_scores, "hashtags"),
+            run_stage(self.calculate_keywords_score, "keywords"),
+        )
+        with timed_stage("combine"):
+            return self.combine_scores(
+                interaction_scores, hashtag_scores, keyword_scores, limit=limit
+            )
 
+    @staticmethod
+    def combine_scores(interaction_scores, hashtag_scores, keyword_scores, limit=None):
+        """
+        The (user_id, score) ranking from the three stages, with the arrays of
+        recommend.combine when there are many candidates
+        """
+        candidates = len(interaction_scores) + len(hashtag_scores) + len(keyword_scores)
+        CANDIDATES_SCORED.inc(candidates)
+        if np is not None and candidates >= VECTORIZE_MIN_CANDIDATES:
+            return combine_scores_vectorized(
+                interaction_scores, hashtag_scores, keyword_scores, limit=limit
+            )
+        return RankingScore.combine_scores_python(
+            interaction_scores, hashtag_scores, keyword_scores, limit=limit
+        )
+
+    @staticmethod
+    def combine_scores_python(
+        interaction_scores, hashtag_scores, keyword_scores, limit=None
+    ):
         final_scores = {}
         for user_id in (
             set(interaction_scores) | set(hashtag_scores) | set(keyword_scores)
@@ -232,57 +280,275 @@ class RankingScore:
             if final_score > 0:
                 final_scores[user_id] = round(final_score, 5)
 
-        sorted_final_scores = sorted(
-            final_scores.items(), key=lambda item: (-item[1], -item[0]), reverse=True
-        )
+        def sort_key(item):
+            return (-item[1], -item[0])
+
+        if limit is not None and limit < len(final_scores):
+            # a heap of limit items instead of sorting every candidate, same
+            # result as the sorted list cut at limit
+            return heapq.nlargest(limit, final_scores.items(), key=sort_key)
+
+        sorted_final_scores = sorted(final_scores.items(), key=sort_key, reverse=True)
 
         return sorted_final_scores
 
 
-@api_view(["GET"])
-def recommend_users(request):
-    user_id = request.query_params.get("user_id")
-    spec_type = request.query_params.get("type", "both")
-    phrase = unquote(request.query_params.get("phrase", ""))
-    hashtag = request.query_params.get("hashtag")
+class SQLRankingScore(RankingScore):
+    """
+    RankingScore computing the final scores in a single query, see
+    recommend.ranking_sql. The per stage methods are still the Python ones
+    """
 
-    if not user_id:
-        return Response(
-            {"error": "user_id is required"}, status=status.HTTP_400_BAD_REQUEST
+    def calculate_final_scores(self, limit=None):
+        with timed_stage("ranking"):
+            return rank_users(self.user_id, self.query_type, self.phrase, limit=limit)
+
+    async def acalculate_final_scores(self, limit=None):
+        return await run_stage(lambda: self.calculate_final_scores(limit=limit))
+
+
+class BatchRankingScore:
+    """
+    The rankings of many users for the same type, phrase and hashtag. Every
+    stage is a single query for all the users, grouped by user afterwards, and
+    each ranking is the one RankingScore gives for that user
+    """
+
+    def __init__(self, user_ids, query_type, phrase, hashtag):
+        self.user_ids = list(dict.fromkeys(user_ids))
+        self.query_type = query_type
+        self.phrase = phrase
+        self.hashtag = hashtag
+
+    def calculate_interaction_scores(self):
+        interaction_scores = {user_id: {} for user_id in self.user_ids}
+        interactions = UserInteraction.objects.filter(
+            user_a_id__in=self.user_ids
+        ).values_list("user_a_id", "user_b_id", "reply_count", "retweet_count")
+        for user_id, other_user_id, reply_count, retweet_count in interactions:
+            interaction_scores[user_id][other_user_id] = RankingScore.interaction_score(
+                reply_count, retweet_count
+            )
+        return interaction_scores
+
+    def calculate_hashtag_scores(self):
+        user_hashtags = defaultdict(dict)
+        usages = (
+            HashtagUsage.objects.filter(user_id__in=self.user_ids)
+            .order_by("user_id", "tag")
+            .values_list("user_id", "tag", "count")
         )
+        for user_id, tag, count in usages:
+            user_hashtags[user_id][tag] = count
+
+        # the postings of every tag used by any of the users, fetched once
+        postings = defaultdict(dict)
+        tags = {tag for hashtags in user_hashtags.values() for tag in hashtags}
+        for tag, user_id, count in (
+            HashtagUsage.objects.filter(tag__in=tags)
+            .order_by("tag", "user_id")
+            .values_list("tag", "user_id", "count")
+        ):
+            postings[tag][user_id] = count
 
-    try:
-        user_id = int(user_id)
-    except ValueError:
-        return Response(
-            {"error": "user_id must be an integer"}, status=status.HTTP_400_BAD_REQUEST
+        return {
+            user_id: RankingScore.hashtag_scores_from(
+                user_id, user_hashtags[user_id], postings
+            )
+            for user_id in self.user_ids
+        }
+
+    def calculate_keywords_score(self):
+        if self.query_type not in ["reply", "retweet", "both"]:
+            raise ValueError(
+                "Invalid query_type. Must be 'reply', 'retweet', or 'both'."
+            )
+
+        replies = self.query_type in ["reply", "both"]
+        retweets = self.query_type in ["retweet", "both"]
+        tweet_filter = Q(pk__in=[])
+        if replies:
+            tweet_filter |= Q(
+                Q(reply_to_user_id__in=self.user_ids) | Q(user_id__in=self.user_ids),
+                reply_to_user__isnull=False,
+            )
+        if retweets:
+            tweet_filter |= Q(
+                Q(retweet__user_id__in=self.user_ids) | Q(user_id__in=self.user_ids),
+                retweet__isnull=False,
+            )
+
+        tweets = (
+            Tweet.objects.filter(tweet_filter, lang__in=valid_languages)
+            .annotate(
+                phrase_matches=phrase_matches(self.phrase),
+                hashtag_matches=Count(
+                    "hashtag", filter=Q(hashtag__text__icontains=self.phrase)
+                ),
+            )
+            .values(
+                "user_id",
+                "phrase_matches",
+                "hashtag_matches",
+                "reply_to_user_id",
+                "retweet_id",
+                "retweet__user_id",
+            )
+            .order_by("id")
+        )
+
+        keyword_scores = {user_id: {} for user_id in self.user_ids}
+        for tweet in tweets:
+            # the users of the batch this tweet is a contact tweet of
+            contacts = set()
+            if replies and tweet["reply_to_user_id"] is not None:
+                contacts.update([tweet["reply_to_user_id"], tweet["user_id"]])
+            if retweets and tweet["retweet_id"] is not None:
+                contacts.update([tweet["retweet__user_id"], tweet["user_id"]])
+
+            keyword_score = RankingScore.keyword_score(tweet)
+            for user_id in contacts:
+                if user_id in keyword_scores:
+                    keyword_scores[user_id][tweet["user_id"]] = keyword_score
+
+        return keyword_scores
+
+    def calculate_final_scores(self, limit=None):
+        """
+        {user_id: ranking} of every user of the batch
+        """
+        interaction_scores = self.calculate_interaction_scores()
+        hashtag_scores = self.calculate_hashtag_scores()
+        keyword_scores = self.calculate_keywords_score()
+
+        return {
+            user_id: RankingScore.combine_scores(
+                interaction_scores[user_id],
+                hashtag_scores[user_id],
+                keyword_scores[user_id],
+                limit=limit,
+            )
+            for user_id in self.user_ids
+        }
+
+
+# both engines rank the same, so they share the cached scores
+RANKING_ENGINES = {"python": RankingScore, "sql": SQLRankingScore}
+
+
+def get_ranking_engine(name=None):
+    """
+    The ranking class named name, the one of the RECOMMEND_ENGINE setting by
+    default. None when there is no engine of that name
+    """
+    if not name:
+        name = settings.RECOMMEND_ENGINE
+        if name not in RANKING_ENGINES:
+            raise ImproperlyConfigured(
+                f"RECOMMEND_ENGINE must be one of {', '.join(RANKING_ENGINES)}, "
+                f"not {name!r}"
+            )
+    return RANKING_ENGINES.get(name)
+
+
+async def run_stage(stage, name=None):
+    """
+    Run a scoring stage outside of the event loop thread, timed as name when
+    given. The worker threads aren't request threads, so their connections are
+    closed here the way the request_started/finished signals would
+    """
+
+    def run():
+        close_old_connections()
+        try:
+            with timed_stage(name) if name else nullcontext():
+                return stage()
+        finally:
+            close_old_connections()
+
+    return await sync_to_async(run, thread_sensitive=False)()
+
+
+def latest_contact_tweets_queryset(user_id, target_user_ids):
+    # DISTINCT ON keeps the first row of every user, the latest contact tweet
+    return (
+        Tweet.objects.filter(
+            Q(user_id__in=target_user_ids)
+            & (Q(reply_to_user_id=user_id) | Q(retweet__user_id=user_id)),
+            lang__in=valid_languages,
         )
+        .order_by("user_id", "-created_at", "-id")
+        .distinct("user_id")
+        .values_list("user_id", "text")
+    )
+
 
-    scorer = RankingScore(
-        user_id=user_id,
-        query_type=spec_type,
-        phrase=phrase,
-        hashtag=hashtag,
+def hydrate_recommendations(user_id, final_scores):
+    """
+    Load the profiles and the latest contact tweet of the ranked users. Both are
+    fetched in one query each, whatever the number of recommended users
+    """
+    target_user_ids = [target_user_id for target_user_id, _ in final_scores]
+
+    users = TweetUser.objects.in_bulk(target_user_ids)
+    contact_tweets = dict(latest_contact_tweets_queryset(user_id, target_user_ids))
+    ROWS_FETCHED.inc(len(users) + len(contact_tweets), stage="hydrate")
+
+    return recommendation_rows(target_user_ids, users, contact_tweets)
+
+
+def hydrate_recommendations_batch(rankings):
+    """
+    hydrate_recommendations of every {user_id: final_scores} in rankings, with
+    one query for all the profiles and one for all the contact tweets
+    """
+    target_user_ids = {
+        target_user_id
+        for final_scores in rankings.values()
+        for target_user_id, _ in final_scores
+    }
+    users = TweetUser.objects.in_bulk(target_user_ids)
+
+    # the latest contact tweet of every (user, target) pair
+    latest_tweets = {}
+    tweets = Tweet.objects.filter(
+        Q(user_id__in=target_user_ids)
+        & (Q(reply_to_user_id__in=rankings) | Q(retweet__user_id__in=rankings)),
+        lang__in=valid_languages,
+    ).values_list(
+        "user_id", "reply_to_user_id", "retweet__user_id", "created_at", "id", "text"
     )
-    final_scores = scorer.calculate_final_scores()
+    for target_user_id, reply_to_user_id, retweet_user_id, *order, text in tweets:
+        # same order as the DISTINCT ON of latest_contact_tweets_queryset
+        order = tuple(order)
+        for user_id in {reply_to_user_id, retweet_user_id} & rankings.keys():
+            key = (user_id, target_user_id)
+            if key not in latest_tweets or order > latest_tweets[key][0]:
+                latest_tweets[key] = (order, text)
+
+    return {
+        user_id: recommendation_rows(
+            [target_user_id for target_user_id, _ in final_scores],
+            users,
+            {
+                target_user_id: latest_tweets[user_id, target_user_id][1]
+                for target_user_id, _ in final_scores
+                if (user_id, target_user_id) in latest_tweets
+            },
+        )
+        for user_id, final_scores in rankings.items()
+    }
 
-    response_data = []
 
-    for target_user_id, score in final_scores:
-        user = TweetUser.objects.filter(id=target_user_id).first()
+def recommendation_rows(target_user_ids, users, contact_tweets):
+    response_data = []
+    for target_user_id in target_user_ids:
+        user = users.get(target_user_id)
         if not user:
             continue
 
-        tweet = (
-            Tweet.objects.filter(
-                Q(user_id=target_user_id)
-                & (Q(reply_to_user_id=user_id) | Q(retweet__user_id=user_id)),
-                lang__in=valid_languages,
-            )
-            .order_by("-created_at", "-id")
-            .first()
-        )
-        contact_tweet_text = " ".join(tweet.text) if tweet else ""
+        tweet_text = contact_tweets.get(target_user_id)
+        contact_tweet_text = " ".join(tweet_text) if tweet_text else ""
 
         response_data.append(
             {
@@ -293,9 +559,258 @@ def recommend_users(request):
             }
         )
 
-    formatted_response = "\n".join(
+    return response_data
+
+
+def parse_recommend_params(query_params):
+    """
+    The (user_id, type, phrase, hashtag) of a recommendation request, or the
+    error message when they are invalid
+    """
+    user_id = query_params.get("user_id")
+    spec_type = query_params.get("type", "both")
+    phrase = unquote(query_params.get("phrase", ""))
+    hashtag = query_params.get("hashtag")
+
+    if not user_id:
+        return None, "user_id is required"
+
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return None, "user_id must be an integer"
+
+    return (user_id, spec_type, phrase, hashtag), None
+
+
+def parse_engine_param(query_params):
+    """
+    The ranking class asked for by the engine parameter, or the error message
+    when there is no such engine
+    """
+    engine = get_ranking_engine(query_params.get("engine"))
+    if engine is None:
+        return None, f"engine must be one of {', '.join(map(repr, RANKING_ENGINES))}"
+    return engine, None
+
+
+def parse_page_params(query_params):
+    """
+    The (offset, limit) of the requested page of the ranking, a limit of None
+    is the whole ranking. Or the error message when they are invalid
+    """
+    page = []
+    for name, default in [("offset", 0), ("limit", None)]:
+        value = query_params.get(name)
+        if value is None or value == "":
+            page.append(default)
+            continue
+        try:
+            value = int(value)
+        except ValueError:
+            return None, f"{name} must be an integer"
+        if value < 0:
+            return None, f"{name} must not be negative"
+        page.append(value)
+
+    return tuple(page), None
+
+
+def is_integer(value):
+    # bool is a subclass of int, but true isn't a user id
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def format_recommendations(user_id, final_scores):
+    """
+    Hydrate the ranked users into the text response
+    """
+    return format_response_data(hydrate_recommendations(user_id, final_scores))
+
+
+def format_response_data(response_data):
+    return "\n".join(
         f"{data['user_id']}\t{data['screen_name']}\t{data['description']}\t{data['contact_tweet_text']}"
         for data in response_data
     )
 
+
+def page_scores_key(params, page):
+    """
+    Cache key of the ranked scores a page is cut from, and the number of users
+    to rank for it (None for all of them)
+    """
+    offset, limit = page
+    top = None if limit is None else offset + limit
+    return params + (top,), top
+
+
+# the ranking only reads, ATOMIC_REQUESTS would just hold a transaction open
+# around it
+@transaction.non_atomic_requests
+@instrumented
+@api_view(["GET"])
+def recommend_users(request):
+    params, error = parse_recommend_params(request.query_params)
+    if not error:
+        page, error = parse_page_params(request.query_params)
+    if not error:
+        engine, error = parse_engine_param(request.query_params)
+    if error:
+        return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+    version = get_dataset_version()
+
+    response_key = params + page
+    formatted_response = recommendation_cache.get("response", response_key, version)
+    if formatted_response is None:
+        scores_key, top = page_scores_key(params, page)
+        final_scores = recommendation_cache.get("scores", scores_key, version)
+        if final_scores is None:
+            scorer = engine(*params, graph=get_interaction_graph(version))
+            final_scores = scorer.calculate_final_scores(limit=top)
+            recommendation_cache.set("scores", scores_key, version, final_scores)
+
+        # only the users of the page are hydrated
+        with timed_stage("hydrate"):
+            formatted_response = format_recommendations(
+                params[0], final_scores[page[0] : top]
+            )
+        recommendation_cache.set("response", response_key, version, formatted_response)
+
     return Response(formatted_response, content_type="text/plain")
+
+
+def hydrate_page(user_id, final_scores):
+    with timed_stage("hydrate"):
+        return format_recommendations(user_id, final_scores)
+
+
+# ATOMIC_REQUESTS can't wrap async views, and the concurrent stages each run on
+# their own connection anyway
+@transaction.non_atomic_requests
+@instrumented
+@require_GET
+async def recommend_users_async(request):
+    """
+    The recommend_users endpoint for ASGI servers, the interaction, hashtag and
+    keyword stages of a request are run concurrently. The response is the same
+    as the one of recommend_users
+    """
+    params, error = parse_recommend_params(request.GET)
+    if not error:
+        page, error = parse_page_params(request.GET)
+    if not error:
+        engine, error = parse_engine_param(request.GET)
+    if error:
+        return JsonResponse({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+    version = await sync_to_async(get_dataset_version)()
+
+    cache_get = sync_to_async(recommendation_cache.get)
+    cache_set = sync_to_async(recommendation_cache.set)
+    response_key = params + page
+    formatted_response = await cache_get("response", response_key, version)
+    if formatted_response is None:
+        scores_key, top = page_scores_key(params, page)
+        final_scores = await cache_get("scores", scores_key, version)
+        if final_scores is None:
+            # the first call after a version bump maps the graph snapshot
+            graph = await sync_to_async(get_interaction_graph)(version)
+            scorer = engine(*params, graph=graph)
+            final_scores = await scorer.acalculate_final_scores(limit=top)
+            await cache_set("scores", scores_key, version, final_scores)
+
+        formatted_response = await sync_to_async(hydrate_page)(
+            params[0], final_scores[page[0] : top]
+        )
+        await cache_set("response", response_key, version, formatted_response)
+
+    return HttpResponse(
+        JSONRenderer().render(formatted_response), content_type="text/plain"
+    )
+
+
+MAX_BATCH_USERS = 1000
+
+
+@transaction.non_atomic_requests
+@instrumented
+@api_view(["POST"])
+def recommend_users_batch(request):
+    """
+    The recommendations of many users at once, for the same type, phrase and
+    hashtag. Takes a JSON body like
+    {"user_ids": [...], "type": "both", "phrase": "...", "hashtag": "..."}
+    with optional limit and offset, and returns the /q2 response of every user
+    keyed by user id. The queries are shared by all the users
+    """
+    if not isinstance(request.data, dict):
+        return Response(
+            {"error": "the body must be a JSON object"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    user_ids = request.data.get("user_ids")
+    spec_type = request.data.get("type", "both")
+    phrase = request.data.get("phrase", "")
+    hashtag = request.data.get("hashtag")
+
+    error = None
+    if not isinstance(user_ids, list) or not user_ids:
+        error = "user_ids must be a non empty list"
+    elif not all(is_integer(user_id) for user_id in user_ids):
+        error = "user_ids must be integers"
+    elif len(user_ids) > MAX_BATCH_USERS:
+        error = f"at most {MAX_BATCH_USERS} user_ids per request"
+    elif spec_type not in ["reply", "retweet", "both"]:
+        error = "type must be 'reply', 'retweet', or 'both'"
+    elif not isinstance(phrase, str):
+        error = "phrase must be a string"
+    elif hashtag is not None and not isinstance(hashtag, str):
+        error = "hashtag must be a string"
+    else:
+        # the JSON values must be integers already, int() would take 1.7 or "1"
+        for name in ("offset", "limit"):
+            value = request.data.get(name)
+            if value is not None and not is_integer(value):
+                error = f"{name} must be an integer"
+                break
+        else:
+            page, error = parse_page_params(request.data)
+    if error:
+        return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+    offset, limit = page
+    top = None if limit is None else offset + limit
+    rankings = BatchRankingScore(
+        user_ids, spec_type, phrase, hashtag
+    ).calculate_final_scores(limit=top)
+
+    response_data = hydrate_recommendations_batch(
+        {
+            user_id: final_scores[offset:top]
+            for user_id, final_scores in rankings.items()
+        }
+    )
+    return Response(
+        {
+            str(user_id): format_response_data(data)
+            for user_id, data in response_data.items()
+        }
+    )
+
+
+@api_view(["GET"])
+def recommendation_cache_stats(request):
+    return Response(recommendation_cache.stats())
+
+
+@require_GET
+def metrics(request):
+    """
+    The metrics of recommend.metrics, in the Prometheus text format
+    """
+    return HttpResponse(
+        registry.exposition(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
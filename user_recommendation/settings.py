@@ -34,7 +34,7 @@ SECRET_KEY = "django-insecure-hi5%kldf3tmn27nytx@u1&ib!e$4^cbpi3e#t&gua+5+bpgjmt
 DEBUG = env.bool("DJANGO_DEBUG", False)
 
 
-ALLOWED_HOSTS: list[Any] = []
+ALLOWED_HOSTS: list[Any] = env.list("DJANGO_ALLOWED_HOSTS", default=[])
 
 
 # Application definition
@@ -100,10 +100,73 @@ DATABASES = {
         "PASSWORD": env.str("POSTGRES_PASSWORD"),
         "HOST": env.str("POSTGRES_HOST"),
         "PORT": env.int("POSTGRES_PORT"),
+        "OPTIONS": {},
     }
 }
 DATABASES["default"]["ATOMIC_REQUESTS"] = True
 
+# Connections are opened per request by default. POSTGRES_POOL keeps them in a
+# psycopg pool instead, POSTGRES_CONN_MAX_AGE keeps one per thread (not both)
+DATABASES["default"]["CONN_MAX_AGE"] = env.int("POSTGRES_CONN_MAX_AGE", 0)
+if env.bool("POSTGRES_POOL", False):
+    DATABASES["default"]["OPTIONS"]["pool"] = {
+        "min_size": env.int("POSTGRES_POOL_MIN_SIZE", 2),
+        "max_size": env.int("POSTGRES_POOL_MAX_SIZE", 10),
+        "timeout": env.float("POSTGRES_POOL_TIMEOUT", 10.0),
+    }
+# with the parameters bound on the server, the scoring queries are prepared on
+# a connection once they ran POSTGRES_PREPARE_THRESHOLD times. Only worth it
+# with pooled or persistent connections
+if env.bool("POSTGRES_PREPARED_STATEMENTS", False):
+    DATABASES["default"]["OPTIONS"]["server_side_binding"] = True
+    DATABASES["default"]["OPTIONS"]["prepare_threshold"] = env.int(
+        "POSTGRES_PREPARE_THRESHOLD", 5
+    )
+# the test database is UTF8 like the one of the postgres image, whatever the
+# default encoding of the server running the tests
+DATABASES["default"]["TEST"] = {"CHARSET": "UTF8", "TEMPLATE": "template0"}
+
+
+# Recommendation cache
+# MAX_ENTRIES bounds the in-process LRU (0 disables it), BACKEND optionally
+# names one of the CACHES to share the entries between processes
+
+RECOMMEND_CACHE = {
+    "MAX_ENTRIES": env.int("RECOMMEND_CACHE_MAX_ENTRIES", 4096),
+    "BACKEND": env.str("RECOMMEND_CACHE_BACKEND", None),
+    "TIMEOUT": env.int("RECOMMEND_CACHE_TIMEOUT", 3600),
+}
+
+# Ranking engine, "python" computes the scores stage by stage, "sql" in a
+# single query. Requests can pick one with the engine query parameter
+RECOMMEND_ENGINE = env.str("RECOMMEND_ENGINE", "python")
+
+# Directory of the interaction graph snapshots built by build_graph_snapshot,
+# when set the interaction scores are read from there (needs numpy)
+RECOMMEND_GRAPH_SNAPSHOT = env.str("RECOMMEND_GRAPH_SNAPSHOT", None)
+
+# Share of the /q2 requests timed stage by stage, between 0 (none) and 1 (all).
+# The timings are sent in the Server-Timing header and logged as JSON by the
+# recommend.timing logger
+RECOMMEND_TIMING_SAMPLE_RATE = env.float("RECOMMEND_TIMING_SAMPLE_RATE", 0.0)
+
+# Directory shared by the worker processes to sum their metrics on /metrics,
+# without it /metrics only shows the ones of the process answering
+RECOMMEND_METRICS_DIR = env.str("RECOMMEND_METRICS_DIR", None)
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "recommend.timing": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators